@@ -4,29 +4,82 @@
 # ----------------------------------------------------
 from flask import Flask, render_template, request, redirect, url_for, flash, make_response # make_response adicionado
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func
-from sqlalchemy.orm import joinedload # Para o histórico
+from sqlalchemy import func, update, insert, text, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from rapidfuzz import fuzz as rf_fuzz, process as rf_process
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, date, timezone
 import os
+import click
 import io
 import csv
-from flask import Response
+import json
+import itertools
+import time
+import threading
+import bisect
+import collections
+import functools
+import hashlib
+import gzip
+import concurrent.futures
+import unicodedata
+import statistics
+import numpy as np
+from flask import Response, stream_with_context, jsonify, session, send_file, abort
 
 # --- Configuração Inicial ---
+# O objeto app e as extensões existem desde o import (as rotas abaixo se registram nele), mas só são
+# configurados em create_app(), conforme o perfil escolhido em STOCKIFY_PERFIL.
 app = Flask(__name__)
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(BASE_DIR, 'estoque.db')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SECRET_KEY'] = 'uma_chave_secreta_muito_forte_aqui'
-
-db = SQLAlchemy(app)
+db = SQLAlchemy()
 login_manager = LoginManager()
-login_manager.init_app(app)
 login_manager.login_view = 'login'
 
-lista_pedidos = {}
+# --- PERFIS DE CONFIGURAÇÃO ---
+# SQLITE_PRAGMAS roda em toda conexão nova do pool (gunicorn, flask CLI ou __main__):
+# - WAL deixa leitores e o escritor trabalharem ao mesmo tempo;
+# - busy_timeout faz escritores concorrentes esperarem na fila pelo lock em vez de falhar com "database is locked";
+# - foreign_keys=ON é obrigatório, senão o ON DELETE CASCADE do banco é ignorado.
+# Produção acrescenta synchronous=NORMAL (seguro com WAL; só o último commit pode se perder numa queda
+# de energia), leitura por mmap e um cache de páginas maior por conexão.
+SQLITE_BUSY_TIMEOUT_MS = 5000
+THREADS_POR_WORKER = int(os.environ.get('STOCKIFY_THREADS', 64)) # Mesmo valor lido pelo gunicorn.conf.py
+PERFIS = {
+    'desenvolvimento': {
+        'DEBUG': True,
+        'SECRET_KEY': 'uma_chave_secreta_muito_forte_aqui',
+        'SENHA_ADMIN_PADRAO': '123',
+        'SQLITE_PRAGMAS': [('foreign_keys', 'ON'), ('journal_mode', 'WAL'), ('busy_timeout', SQLITE_BUSY_TIMEOUT_MS)],
+        'SQLALCHEMY_ENGINE_OPTIONS': {},
+    },
+    'producao': {
+        'DEBUG': False,
+        'SECRET_KEY': None, # Obrigatória via STOCKIFY_SECRET_KEY
+        'SENHA_ADMIN_PADRAO': None, # Admin inicial só com STOCKIFY_ADMIN_SENHA
+        'TEMPLATES_AUTO_RELOAD': False,
+        'SEND_FILE_MAX_AGE_DEFAULT': 86400, # Arquivos estáticos
+        'SQLITE_PRAGMAS': [
+            ('foreign_keys', 'ON'), ('journal_mode', 'WAL'), ('synchronous', 'NORMAL'),
+            ('busy_timeout', SQLITE_BUSY_TIMEOUT_MS), ('mmap_size', 256 * 1024 * 1024),
+            ('cache_size', -64 * 1024), ('temp_store', 'MEMORY'), # cache_size negativo = KiB
+        ],
+        # Uma conexão por thread de requisição do worker (streams SSE devolvem a sua ao pool); o overflow
+        # cobre as threads de segundo plano (tarefas, previsões, leitura do log para o SSE)
+        'SQLALCHEMY_ENGINE_OPTIONS': {'pool_size': int(os.environ.get('STOCKIFY_POOL_SIZE', THREADS_POR_WORKER)), 'max_overflow': 8, 'pool_timeout': 30},
+    },
+}
+
+def configurar_sqlite(engine, pragmas):
+    @event.listens_for(engine, "connect")
+    def aplicar_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for nome, valor in pragmas:
+            cursor.execute(f"PRAGMA {nome}={valor}")
+        cursor.close()
 
 # --- MODELOS DE DADOS ---
 class Produto(db.Model):
@@ -51,7 +104,153 @@ class Movimento(db.Model):
     tipo = db.Column(db.String(10), nullable=False)
     quantidade = db.Column(db.Integer, nullable=False)
     timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
-    produto = db.relationship('Produto', backref=db.backref('movimentos', lazy=True, cascade="all, delete-orphan")) # cascade adicionado
+    # passive_deletes: a exclusão dos movimentos fica com o ON DELETE CASCADE do banco, sem carregar o ledger na sessão
+    produto = db.relationship('Produto', backref=db.backref('movimentos', lazy=True, cascade="all, delete-orphan", passive_deletes=True))
+
+    # Relatórios e exportações filtram por tipo + período; o ledger de um produto é lido por produto + período
+    __table_args__ = (
+        db.Index('ix_movimento_tipo_timestamp', 'tipo', 'timestamp'),
+        db.Index('ix_movimento_produto_timestamp', 'produto_id', 'timestamp'),
+    )
+
+# --- LISTA DE PEDIDOS (PERSISTIDA E COMPARTILHADA ENTRE WORKERS) ---
+class ItemPedido(db.Model):
+    produto_id = db.Column(db.Integer, db.ForeignKey('produto.id', ondelete='CASCADE'), primary_key=True) # Um item por produto
+    quantidade = db.Column(db.Integer, nullable=False)
+    atualizado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+    produto = db.relationship('Produto')
+
+# --- PREVISÃO DE DEMANDA (PRÉ-CALCULADA) ---
+# Uma linha por produto com consumo recente (esparso); recalculada por atualizar_previsoes().
+class PrevisaoDemanda(db.Model):
+    produto_id = db.Column(db.Integer, db.ForeignKey('produto.id', ondelete='CASCADE'), primary_key=True)
+    consumo_diario = db.Column(db.Float, nullable=False)
+    desvio_diario = db.Column(db.Float, nullable=False)
+    dias_cobertura = db.Column(db.Float, nullable=False)
+    sugestao = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_previsao_demanda_cobertura', 'dias_cobertura'), # Sugestões mais urgentes primeiro
+    )
+
+# --- SALDOS DIÁRIOS (SNAPSHOTS DO LEDGER) ---
+# Saldo de fechamento de um produto num dia em que ele teve movimento (esparso: dias sem movimento
+# herdam o último saldo). Construído de forma incremental a partir dos movimentos novos.
+class SaldoDiario(db.Model):
+    produto_id = db.Column(db.Integer, db.ForeignKey('produto.id', ondelete='CASCADE'), primary_key=True)
+    dia = db.Column(db.Date, primary_key=True)
+    saldo = db.Column(db.Integer, nullable=False)
+
+# --- LOG DE ALTERAÇÕES DO CATÁLOGO ---
+# Cada escrita que muda um produto (nome ou estoque) grava uma linha aqui na mesma transação. Os workers
+# leem só as linhas novas (id > último visto) para atualizar seus caches em memória sem reconstruí-los e
+# para avisar as telas abertas (SSE). nome = nome atual do produto; None indica que ele foi excluído.
+class AlteracaoProduto(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    produto_id = db.Column(db.Integer, nullable=False)
+    nome = db.Column(db.String(100))
+    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+def registrar_alteracao(produto_id, nome):
+    db.session.add(AlteracaoProduto(produto_id=produto_id, nome=nome))
+    incrementar_versao_estoque()
+
+# Mudança só de estoque: copia o nome atual com INSERT ... SELECT, sem carregar os produtos
+def registrar_alteracoes_estoque(produto_ids):
+    produto_ids = list(produto_ids)
+    for i in range(0, len(produto_ids), TAMANHO_BLOCO_IN):
+        db.session.execute(insert(AlteracaoProduto).from_select(
+            ['produto_id', 'nome', 'timestamp'],
+            db.select(Produto.id, Produto.nome, db.literal(datetime.utcnow())).where(Produto.id.in_(produto_ids[i:i + TAMANHO_BLOCO_IN]))
+        ))
+    incrementar_versao_estoque()
+
+# Os leitores do log só aplicam o estado mais recente de cada produto, então basta guardar a última
+# linha por produto: um cursor em qualquer id ainda encontra, acima dele, a versão atual de todo
+# produto alterado depois. Remove as linhas superadas (rode no inicializar e periodicamente, via cron).
+def limpar_alteracoes():
+    removidas = db.session.execute(text(
+        "DELETE FROM alteracao_produto WHERE id NOT IN (SELECT MAX(id) FROM alteracao_produto GROUP BY produto_id)"
+    )).rowcount
+    db.session.commit()
+    return removidas
+
+@app.cli.command('limpar-alteracoes')
+def limpar_alteracoes_comando():
+    """Remove do log de alterações as linhas já superadas por uma alteração mais nova do mesmo produto."""
+    print(f"{limpar_alteracoes()} alteração(ões) antiga(s) removida(s).")
+
+# --- VERSÃO DOS DADOS DE ESTOQUE ---
+# Contador no SQLite incrementado na mesma transação de toda escrita em produtos/movimentos.
+# Como fica no banco, todos os workers do gunicorn enxergam a mesma versão; um cache em memória
+# só precisa comparar o número (uma leitura pela PK) para saber se ainda é válido.
+# A chave 'estoque_atualizado_em' guarda o instante da última escrita (segundos Unix), para o Last-Modified.
+class VersaoDados(db.Model):
+    chave = db.Column(db.String(50), primary_key=True)
+    versao = db.Column(db.Integer, nullable=False, default=0)
+
+def incrementar_versao_estoque():
+    stmt = sqlite_insert(VersaoDados).values([
+        {'chave': 'estoque', 'versao': 1},
+        {'chave': 'estoque_atualizado_em', 'versao': int(time.time())},
+    ])
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=[VersaoDados.chave],
+        set_={'versao': db.case((VersaoDados.chave == 'estoque', VersaoDados.versao + 1), else_=stmt.excluded.versao)}
+    ))
+
+def versao_estoque():
+    return db.session.query(VersaoDados.versao).filter_by(chave='estoque').scalar() or 0
+
+# (versão, instante da última escrita) numa única leitura
+def estado_estoque():
+    valores = dict(db.session.query(VersaoDados.chave, VersaoDados.versao).filter(
+        VersaoDados.chave.in_(('estoque', 'estoque_atualizado_em'))
+    ).all())
+    atualizado_em = valores.get('estoque_atualizado_em')
+    return valores.get('estoque', 0), datetime.fromtimestamp(atualizado_em, timezone.utc) if atualizado_em else None
+
+# Cache por worker de um valor derivado do estoque, válido enquanto versao_estoque() não mudar
+# (e, se validade_segundos for informado, até essa idade, para dados que dependem do relógio).
+class CacheVersionado:
+    def __init__(self, construir, validade_segundos=None):
+        self.construir = construir
+        self.validade_segundos = validade_segundos
+        self.construido_em = 0.0
+        self.lock = threading.Lock()
+        self.versao = None
+        self.dados = None
+        self.acertos = 0
+        self.falhas = 0
+        self.ultima_reconstrucao_ms = 0.0
+        self.total_reconstrucao_ms = 0.0
+
+    def obter(self):
+        versao = versao_estoque()
+        with self.lock:
+            expirado = self.validade_segundos is not None and time.monotonic() - self.construido_em > self.validade_segundos
+            if self.versao == versao and not expirado:
+                self.acertos += 1
+                return self.dados
+            self.falhas += 1
+            inicio = time.perf_counter()
+            self.dados = self.construir()
+            self.versao = versao
+            self.construido_em = time.monotonic()
+            self.ultima_reconstrucao_ms = (time.perf_counter() - inicio) * 1000
+            self.total_reconstrucao_ms += self.ultima_reconstrucao_ms
+            return self.dados
+
+    def estatisticas(self):
+        total = self.acertos + self.falhas
+        return {
+            'versao': self.versao,
+            'acertos': self.acertos,
+            'falhas': self.falhas,
+            'taxa_acerto': self.acertos / total if total else 0.0,
+            'ultima_reconstrucao_ms': round(self.ultima_reconstrucao_ms, 3),
+            'media_reconstrucao_ms': round(self.total_reconstrucao_ms / self.falhas, 3) if self.falhas else 0.0,
+        }
 
 # --- NOVO MODELO DE DADOS: HISTÓRICO DE EDIÇÕES ---
 class EditHistory(db.Model):
@@ -65,6 +264,401 @@ class EditHistory(db.Model):
     timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     usuario = db.relationship('Usuario', backref=db.backref('edicoes_feitas', lazy=True))
 
+    __table_args__ = (
+        db.Index('ix_edit_history_timestamp', 'timestamp'), # Ordenação da página de histórico
+        # Filtros da página de histórico; o id (rowid) vai implícito no fim de cada índice e mantém a ordem do cursor
+        db.Index('ix_edit_history_produto_timestamp', 'produto_id', 'timestamp'),
+        db.Index('ix_edit_history_user_timestamp', 'user_id', 'timestamp'),
+        db.Index('ix_edit_history_campo_timestamp', 'campo_alterado', 'timestamp'),
+    )
+
+# Histórico antigo movido por "flask arquivar-historico": mesmas colunas (e ids), fora da tabela quente
+class EditHistoryArquivo(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    produto_id = db.Column(db.Integer)
+    user_id = db.Column(db.Integer, nullable=False) # Sem FK: o arquivo sobrevive à exclusão do usuário
+    campo_alterado = db.Column(db.String(50), nullable=False)
+    nome_produto_na_epoca = db.Column(db.String(100))
+    valor_antigo = db.Column(db.String(255))
+    valor_novo = db.Column(db.String(255))
+    timestamp = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_edit_history_arquivo_timestamp', 'timestamp'),
+    )
+
+# --- TAREFAS EM SEGUNDO PLANO (EXPORTAÇÕES E RELATÓRIOS PESADOS) ---
+# chave = hash do tipo + parâmetros + versão do estoque: pedidos idênticos sobre os mesmos dados
+# reaproveitam a mesma tarefa (em andamento ou já pronta).
+class Tarefa(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    chave = db.Column(db.String(40), nullable=False, index=True)
+    tipo = db.Column(db.String(30), nullable=False)
+    parametros = db.Column(db.Text, nullable=False) # JSON
+    status = db.Column(db.String(15), nullable=False, default='pendente') # pendente, executando, concluida, erro
+    progresso = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer)
+    arquivo = db.Column(db.String(255))
+    erro = db.Column(db.String(255))
+    processo = db.Column(db.Integer) # pid do worker responsável; se ele morrer a tarefa volta para a fila
+    user_id = db.Column(db.Integer, db.ForeignKey('usuario.id'))
+    criado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    concluido_em = db.Column(db.DateTime)
+
+
+# --- MIGRAÇÕES DE ESQUEMA (VERSIONADAS) ---
+# A versão aplicada fica em PRAGMA user_version do SQLite. Cada migração é
+# (versao, descricao, [comandos SQL]) e roda uma única vez, em ordem.
+# Para um banco novo, db.create_all() já cria tudo; os comandos usam IF NOT EXISTS.
+MIGRACOES = [
+    (1, 'Índices de movimento (tipo/produto + timestamp) e de histórico (timestamp)', [
+        "CREATE INDEX IF NOT EXISTS ix_movimento_tipo_timestamp ON movimento (tipo, timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_movimento_produto_timestamp ON movimento (produto_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_edit_history_timestamp ON edit_history (timestamp)",
+    ]),
+    # O SQLite não altera constraints: recria movimento com a FK ON DELETE CASCADE
+    (2, 'ON DELETE CASCADE em movimento.produto_id', [
+        "DROP TABLE IF EXISTS movimento_novo",
+        "CREATE TABLE movimento_novo ("
+        " id INTEGER NOT NULL, produto_id INTEGER NOT NULL, tipo VARCHAR(10) NOT NULL,"
+        " quantidade INTEGER NOT NULL, timestamp DATETIME NOT NULL, PRIMARY KEY (id),"
+        " FOREIGN KEY(produto_id) REFERENCES produto (id) ON DELETE CASCADE)",
+        "INSERT INTO movimento_novo (id, produto_id, tipo, quantidade, timestamp)"
+        " SELECT id, produto_id, tipo, quantidade, timestamp FROM movimento"
+        " WHERE produto_id IN (SELECT id FROM produto)", # Descarta movimentos órfãos, que violariam a FK
+        "DROP TABLE movimento",
+        "ALTER TABLE movimento_novo RENAME TO movimento",
+        "CREATE INDEX IF NOT EXISTS ix_movimento_tipo_timestamp ON movimento (tipo, timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_movimento_produto_timestamp ON movimento (produto_id, timestamp)",
+    ]),
+    (3, 'Índices de filtro do histórico de edições (produto/usuário/campo + timestamp)', [
+        "CREATE INDEX IF NOT EXISTS ix_edit_history_produto_timestamp ON edit_history (produto_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_edit_history_user_timestamp ON edit_history (user_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_edit_history_campo_timestamp ON edit_history (campo_alterado, timestamp)",
+    ]),
+]
+
+def aplicar_migracoes():
+    aplicadas = []
+    with db.engine.begin() as conn:
+        versao_atual = conn.exec_driver_sql("PRAGMA user_version").scalar()
+        for versao, descricao, comandos in MIGRACOES:
+            if versao <= versao_atual:
+                continue
+            for comando in comandos:
+                conn.exec_driver_sql(comando)
+            conn.exec_driver_sql(f"PRAGMA user_version = {int(versao)}")
+            aplicadas.append((versao, descricao))
+        conn.exec_driver_sql("ANALYZE") # Atualiza as estatísticas usadas pelo planejador
+    return aplicadas
+
+@app.cli.command('migrar')
+def migrar_comando():
+    """Aplica as migrações pendentes ao banco configurado."""
+    db.create_all()
+    aplicadas = aplicar_migracoes()
+    for versao, descricao in aplicadas:
+        print(f"Migração {versao} aplicada: {descricao}")
+    if not aplicadas:
+        print("Banco já está na versão mais recente.")
+
+@app.cli.command('verificar-indices')
+def verificar_indices_comando():
+    """Mostra o plano de execução das consultas quentes e se usam índice."""
+    from sqlalchemy.dialects import sqlite
+    inicio = datetime(2000, 1, 1)
+    consultas = {
+        'relatório por tipo/período': Movimento.query.filter(
+            Movimento.tipo == 'saida', Movimento.timestamp >= inicio
+        ).order_by(Movimento.timestamp.desc()),
+        'ledger de um produto': Movimento.query.filter(
+            Movimento.produto_id == 1, Movimento.timestamp >= inicio
+        ).order_by(Movimento.timestamp),
+        'histórico de edições': EditHistory.query.order_by(EditHistory.timestamp.desc()),
+        'histórico de um produto': EditHistory.query.filter(
+            EditHistory.produto_id == 1
+        ).order_by(EditHistory.timestamp.desc(), EditHistory.id.desc()),
+        'histórico de um usuário': EditHistory.query.filter(
+            EditHistory.user_id == 1
+        ).order_by(EditHistory.timestamp.desc(), EditHistory.id.desc()),
+    }
+    tudo_ok = True
+    with db.engine.connect() as conn:
+        for nome, query in consultas.items():
+            sql = str(query.statement.compile(dialect=sqlite.dialect(), compile_kwargs={'literal_binds': True}))
+            plano = [linha[-1] for linha in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + sql)]
+            usa_indice = any('USING INDEX' in p or 'USING COVERING INDEX' in p for p in plano)
+            tudo_ok = tudo_ok and usa_indice
+            print(f"[{'OK' if usa_indice else 'SEM ÍNDICE'}] {nome}")
+            for p in plano:
+                print(f"    {p}")
+    if not tudo_ok:
+        raise SystemExit(1)
+
+# --- BUSCA APROXIMADA DE PRODUTOS (RAPIDFUZZ) ---
+# Índice em memória por worker: nomes normalizados + índice invertido por palavra. Cada palavra do termo
+# é comparada (RapidFuzz) só com o vocabulário de palavras distintas, que é bem menor que o catálogo; os
+# produtos que têm palavras parecidas com todas as do termo viram candidatos e só eles recebem a nota final.
+# É atualizado de forma incremental pelo log AlteracaoProduto, inclusive com escritas de outros workers.
+def normalizar_nome(nome):
+    sem_acento = unicodedata.normalize('NFKD', nome).encode('ascii', 'ignore').decode('ascii')
+    return ' '.join(sem_acento.lower().split())
+
+def _tem_digito(palavra):
+    return any(c.isdigit() for c in palavra)
+
+# Partes de `ids` com alguma palavra de cada termo em `outros` (listas de grupos), na ordem dos grupos
+def _cruzar(ids, outros):
+    if not outros:
+        yield ids
+        return
+    for grupo in outros[0]:
+        parte = ids & grupo
+        if parte:
+            yield from _cruzar(parte, outros[1:])
+
+class IndiceBuscaProdutos:
+    NOTA_MINIMA_PALAVRA = 65 # fuzz.ratio mínimo para considerar duas palavras "iguais"
+    PALAVRAS_POR_TERMO = 30  # Palavras do vocabulário aceitas por palavra digitada
+    MAX_CANDIDATOS = 200
+    TAMANHO_CACHE = 512      # Palavras já resolvidas; a cada tecla só a última palavra é nova
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.nomes = {}        # produto_id -> nome original
+        self.normalizados = {} # produto_id -> nome normalizado
+        self.palavras = {}     # palavra -> set(produto_id)
+        self.vocabulario = []  # Palavras distintas em ordem, para busca por prefixo com bisect
+        self.vocabulario_texto = [] # Só as palavras sem dígitos: códigos/medidas (M8, 1/2) não têm busca aproximada
+        self.ultima_alteracao = None # Último id de AlteracaoProduto aplicado (None = não carregado)
+        self.cache = {}        # (palavra, prefixo) -> set(produto_id); limpo a cada alteração do índice
+
+    def _adicionar(self, produto_id, nome):
+        self._remover(produto_id)
+        self.cache.clear()
+        normalizado = normalizar_nome(nome)
+        self.nomes[produto_id] = nome
+        self.normalizados[produto_id] = normalizado
+        for palavra in set(normalizado.split()):
+            if palavra not in self.palavras:
+                self.palavras[palavra] = set()
+                bisect.insort(self.vocabulario, palavra)
+                if not _tem_digito(palavra): bisect.insort(self.vocabulario_texto, palavra)
+            self.palavras[palavra].add(produto_id)
+
+    def _remover(self, produto_id):
+        normalizado = self.normalizados.pop(produto_id, None)
+        self.nomes.pop(produto_id, None)
+        if normalizado is None:
+            return
+        self.cache.clear()
+        for palavra in set(normalizado.split()):
+            ids = self.palavras.get(palavra)
+            if ids is not None:
+                ids.discard(produto_id)
+                if not ids:
+                    del self.palavras[palavra]
+                    self.vocabulario.pop(bisect.bisect_left(self.vocabulario, palavra))
+                    if not _tem_digito(palavra): self.vocabulario_texto.pop(bisect.bisect_left(self.vocabulario_texto, palavra))
+
+    def _reconstruir(self):
+        self.nomes, self.normalizados, self.palavras, self.vocabulario, self.vocabulario_texto = {}, {}, {}, [], []
+        # Lê o id do log antes dos produtos: alterações concorrentes serão reaplicadas (são idempotentes)
+        self.ultima_alteracao = db.session.query(func.coalesce(func.max(AlteracaoProduto.id), 0)).scalar()
+        for produto_id, nome in db.session.query(Produto.id, Produto.nome).yield_per(5000):
+            self._adicionar(produto_id, nome)
+
+    # Aplica as alterações gravadas depois da última sincronização (normalmente zero linhas, pela PK)
+    def sincronizar(self):
+        with self.lock:
+            if self.ultima_alteracao is None:
+                self._reconstruir()
+                return
+            alteracoes = db.session.query(AlteracaoProduto.id, AlteracaoProduto.produto_id, AlteracaoProduto.nome).filter(
+                AlteracaoProduto.id > self.ultima_alteracao
+            ).order_by(AlteracaoProduto.id).all()
+            for alteracao_id, produto_id, nome in alteracoes:
+                if nome is None:
+                    self._remover(produto_id)
+                elif self.nomes.get(produto_id) != nome:
+                    self._adicionar(produto_id, nome)
+                self.ultima_alteracao = alteracao_id
+
+    # Conjuntos de produtos das palavras parecidas com `termo`, da mais relevante para a menos: a própria
+    # palavra, as que começam com ela (se ainda está sendo digitada) e as aproximadas, em ordem de nota.
+    # Os conjuntos são os do índice (somente leitura): nada é copiado nem unido aqui.
+    def _produtos_por_palavra(self, termo, prefixo):
+        chave = (termo, prefixo)
+        if chave in self.cache:
+            return self.cache[chave]
+        parecidas = [termo] if termo in self.palavras else []
+        if prefixo:
+            inicio = bisect.bisect_left(self.vocabulario, termo)
+            parecidas += itertools.takewhile(lambda p: p.startswith(termo),
+                                             itertools.islice(self.vocabulario, inicio, inicio + self.PALAVRAS_POR_TERMO))
+        if not _tem_digito(termo):
+            parecidas += [p for p, _, _ in rf_process.extract(
+                termo, self.vocabulario_texto, scorer=rf_fuzz.ratio,
+                score_cutoff=self.NOTA_MINIMA_PALAVRA, limit=self.PALAVRAS_POR_TERMO
+            )]
+        grupos = [self.palavras[p] for p in dict.fromkeys(parecidas)]
+        if len(self.cache) >= self.TAMANHO_CACHE:
+            self.cache.clear()
+        self.cache[chave] = grupos
+        return grupos
+
+    # Até MAX_CANDIDATOS produtos, preenchidos a partir dos grupos mais relevantes (cortar antes de ordenar
+    # deixaria de fora a palavra exata quando há muitas parecidas). Com vários termos, parte do mais seletivo
+    # e cruza grupo a grupo com os dos outros, também em ordem, parando quando completa; sem nenhum produto
+    # com todos os termos, vale só o mais amplo.
+    def _candidatos(self, grupos_por_termo):
+        grupos_por_termo = sorted(grupos_por_termo, key=lambda grupos: sum(map(len, grupos)))
+        candidatos = {}
+        for grupo in grupos_por_termo[0]:
+            for parte in _cruzar(grupo, grupos_por_termo[1:]):
+                for pid in parte:
+                    if pid not in candidatos:
+                        candidatos[pid] = self.normalizados[pid]
+                        if len(candidatos) >= self.MAX_CANDIDATOS:
+                            return candidatos
+        if not candidatos and len(grupos_por_termo) > 1:
+            return self._candidatos(grupos_por_termo[-1:])
+        return candidatos
+
+    def buscar(self, termo, limite=10):
+        self.sincronizar()
+        consulta = normalizar_nome(termo)
+        if not consulta:
+            return []
+        with self.lock:
+            resultados = []
+            if consulta.isdigit() and int(consulta) in self.nomes: # Código exato vem primeiro
+                resultados.append((int(consulta), self.nomes[int(consulta)], 100.0))
+            termos = consulta.split()
+            escolhas = self._candidatos([self._produtos_por_palavra(t, prefixo=(i == len(termos) - 1)) for i, t in enumerate(termos)])
+            for _, pontuacao, pid in rf_process.extract(consulta, escolhas, scorer=rf_fuzz.WRatio, limit=limite, score_cutoff=50):
+                if not resultados or pid != resultados[0][0]:
+                    resultados.append((pid, self.nomes[pid], pontuacao))
+            return resultados[:limite]
+
+indice_produtos = IndiceBuscaProdutos()
+
+# --- INSTRUMENTAÇÃO: TEMPOS POR ROTA, CONSULTAS SQL E /metrics ---
+# Hooks do Flask medem a requisição, eventos do engine contam as consultas SQL e o tempo no banco,
+# e os sinais de template medem a renderização. Os números ficam em memória por worker (rótulo
+# "worker" com o pid) e saem em formato texto do Prometheus em /metrics.
+FAIXAS_LATENCIA_S = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class MetricasRequisicoes:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.por_rota = {} # endpoint -> dict com histograma e totais
+
+    def registrar(self, endpoint, status, duracao, consultas, tempo_sql, tempo_template):
+        with self.lock:
+            m = self.por_rota.get(endpoint)
+            if m is None:
+                m = self.por_rota[endpoint] = {
+                    'faixas': [0] * len(FAIXAS_LATENCIA_S), 'contagem': 0, 'soma': 0.0,
+                    'status': {}, 'consultas': 0, 'tempo_sql': 0.0, 'tempo_template': 0.0,
+                }
+            for i, limite in enumerate(FAIXAS_LATENCIA_S):
+                if duracao <= limite:
+                    m['faixas'][i] += 1
+            m['contagem'] += 1
+            m['soma'] += duracao
+            m['status'][status] = m['status'].get(status, 0) + 1
+            m['consultas'] += consultas
+            m['tempo_sql'] += tempo_sql
+            m['tempo_template'] += tempo_template
+
+    def texto_prometheus(self):
+        worker = os.getpid()
+        linhas = [
+            '# HELP stockify_requisicao_segundos Latência das requisições por endpoint.',
+            '# TYPE stockify_requisicao_segundos histogram',
+        ]
+        with self.lock:
+            rotas = sorted(self.por_rota.items())
+            for endpoint, m in rotas:
+                rotulo = f'endpoint="{endpoint}",worker="{worker}"'
+                for limite, qtd in zip(FAIXAS_LATENCIA_S, m['faixas']):
+                    linhas.append(f'stockify_requisicao_segundos_bucket{{{rotulo},le="{limite}"}} {qtd}')
+                linhas.append(f'stockify_requisicao_segundos_bucket{{{rotulo},le="+Inf"}} {m["contagem"]}')
+                linhas.append(f'stockify_requisicao_segundos_sum{{{rotulo}}} {m["soma"]:.6f}')
+                linhas.append(f'stockify_requisicao_segundos_count{{{rotulo}}} {m["contagem"]}')
+            for nome, chave, ajuda in (
+                ('stockify_sql_consultas_total', 'consultas', 'Consultas SQL executadas pelas requisições.'),
+                ('stockify_sql_segundos_total', 'tempo_sql', 'Tempo gasto no banco pelas requisições.'),
+                ('stockify_template_segundos_total', 'tempo_template', 'Tempo gasto renderizando templates.'),
+            ):
+                linhas += [f'# HELP {nome} {ajuda}', f'# TYPE {nome} counter']
+                for endpoint, m in rotas:
+                    linhas.append(f'{nome}{{endpoint="{endpoint}",worker="{worker}"}} {m[chave]:.6f}'.rstrip('0').rstrip('.'))
+            linhas += ['# HELP stockify_requisicoes_total Requisições por endpoint e status HTTP.', '# TYPE stockify_requisicoes_total counter']
+            for endpoint, m in rotas:
+                for status, qtd in sorted(m['status'].items()):
+                    linhas.append(f'stockify_requisicoes_total{{endpoint="{endpoint}",status="{status}",worker="{worker}"}} {qtd}')
+        return '\n'.join(linhas) + '\n'
+
+metricas = MetricasRequisicoes()
+
+def configurar_metricas(app):
+    from flask import g, has_request_context, before_render_template, template_rendered
+
+    @event.listens_for(Engine, "before_cursor_execute")
+    def _inicio_sql(conn, cursor, statement, parameters, context, executemany):
+        if has_request_context():
+            g._inicio_sql = time.perf_counter()
+
+    @event.listens_for(Engine, "after_cursor_execute")
+    def _fim_sql(conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and hasattr(g, '_inicio_sql'):
+            g.consultas_sql = g.get('consultas_sql', 0) + 1
+            g.tempo_sql = g.get('tempo_sql', 0.0) + time.perf_counter() - g._inicio_sql
+
+    def _inicio_template(sender, template, context, **extra):
+        g._inicio_template = time.perf_counter()
+
+    def _fim_template(sender, template, context, **extra):
+        if hasattr(g, '_inicio_template'):
+            g.tempo_template = g.get('tempo_template', 0.0) + time.perf_counter() - g._inicio_template
+
+    before_render_template.connect(_inicio_template, app, weak=False) # weak=False: funções locais seriam coletadas
+    template_rendered.connect(_fim_template, app, weak=False)
+
+    @app.before_request
+    def _inicio_requisicao():
+        g._inicio_requisicao = time.perf_counter()
+
+    @app.after_request
+    def _fim_requisicao(response):
+        if not hasattr(g, '_inicio_requisicao'):
+            return response
+        duracao = time.perf_counter() - g._inicio_requisicao
+        endpoint = request.endpoint or 'desconhecido'
+        consultas, tempo_sql = g.get('consultas_sql', 0), g.get('tempo_sql', 0.0)
+        metricas.registrar(endpoint, response.status_code, duracao, consultas, tempo_sql, g.get('tempo_template', 0.0))
+        limite_ms = app.config['LIMITE_REQUISICAO_LENTA_MS']
+        if limite_ms and duracao * 1000 >= limite_ms:
+            app.logger.warning("Requisição lenta: %s %s %.1fms (%d consultas SQL, %.1fms no banco)",
+                               request.method, request.path, duracao * 1000, consultas, tempo_sql * 1000)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        texto = metricas.texto_prometheus()
+        cache = cache_dashboard.estatisticas()
+        worker = os.getpid()
+        texto += (
+            '# TYPE stockify_cache_dashboard_acertos_total counter\n'
+            f'stockify_cache_dashboard_acertos_total{{worker="{worker}"}} {cache["acertos"]}\n'
+            '# TYPE stockify_cache_dashboard_falhas_total counter\n'
+            f'stockify_cache_dashboard_falhas_total{{worker="{worker}"}} {cache["falhas"]}\n'
+            '# TYPE stockify_cache_dashboard_reconstrucao_ms gauge\n'
+            f'stockify_cache_dashboard_reconstrucao_ms{{worker="{worker}"}} {cache["ultima_reconstrucao_ms"]}\n'
+        )
+        return Response(texto, mimetype='text/plain; version=0.0.4')
 
 @login_manager.user_loader
 def load_user(user_id):
@@ -107,20 +701,320 @@ def logout():
     return redirect(url_for('login'))
 
 
+# --- GET CONDICIONAL (ETAG / LAST-MODIFIED) ---
+# Páginas que só dependem do estoque respondem 304 a partir da versão em versao_dados, sem consultar
+# os produtos nem renderizar o template. O ETag cobre a versão do estoque, o código/templates em uso,
+# o usuário (a barra lateral mostra o nome), a URL completa (filtros, cursor) e se a requisição é HTMX
+# (fragmento x página inteira); `extras` acrescenta o que mais a resposta usar, como o relógio.
+# Só o ETag valida: o Last-Modified vai como informação, pois não distingue usuário nem parâmetros.
+VERSAO_CODIGO = int(max(
+    [os.path.getmtime(__file__)] +
+    [os.path.getmtime(os.path.join(raiz, nome)) for raiz, _, nomes in os.walk(os.path.join(BASE_DIR, 'templates')) for nome in nomes]
+))
+
+def get_condicional(*extras):
+    def decorador(view):
+        @functools.wraps(view)
+        def envolvida(*args, **kwargs):
+            # Mensagens flash pendentes só aparecem numa renderização completa, que não pode virar cache
+            if request.method != 'GET' or session.get('_flashes'):
+                return view(*args, **kwargs)
+            versao, atualizado_em = estado_estoque()
+            partes = [VERSAO_CODIGO, versao, current_user.get_id(), request.full_path, 'HX-Request' in request.headers]
+            etag = hashlib.sha1('|'.join(str(parte) for parte in partes + [extra() for extra in extras]).encode()).hexdigest()
+            if request.if_none_match.contains(etag):
+                resposta = Response(status=304)
+            else:
+                resposta = make_response(view(*args, **kwargs))
+                if resposta.status_code != 200:
+                    return resposta
+            resposta.set_etag(etag)
+            if atualizado_em:
+                resposta.last_modified = atualizado_em
+            resposta.headers['Cache-Control'] = 'private, no-cache' # Sempre revalida, nunca em cache compartilhado
+            resposta.vary.update(('Cookie', 'HX-Request'))
+            return resposta
+        return envolvida
+    return decorador
+
+def _dia_atual():
+    return datetime.utcnow().date()
+
+def _hora_atual():
+    return int(time.time() // 3600)
+
 # --- ROTAS PRINCIPAIS ---
 @app.route('/')
 @login_required
 def root():
     return redirect(url_for('dashboard'))
 
-# --- ROTA DO DASHBOARD (VERSÃO SIMPLES COM 2 GRÁFICOS) ---
+# --- SALDOS DIÁRIOS: COMPACTAÇÃO E CONSULTA NO TEMPO ---
+# Os saldos estão completos até o dia guardado em versao_dados['saldos_compactados_ate'] (como ordinal).
+# Estoque num dia D = último SaldoDiario <= min(D, compactado) + movimentos entre o compactado e D,
+# então uma consulta no passado nunca reprocessa o ledger desde o início.
+DIAS_POR_LOTE_COMPACTACAO = 31
+DIAS_GRAFICO_ESTOQUE = 90
+TIPOS_MOVIMENTO = ('entrada', 'saida') # "tipo IN (...)" deixa o SQLite usar ix_movimento_tipo_timestamp só pelo período
+
+def _delta_movimento():
+    return db.case((Movimento.tipo == 'entrada', Movimento.quantidade), else_=-Movimento.quantidade)
+
+def saldos_compactados_ate():
+    ordinal = db.session.query(VersaoDados.versao).filter_by(chave='saldos_compactados_ate').scalar()
+    return date.fromordinal(ordinal) if ordinal else None
+
+def _definir_compactado_ate(dia):
+    stmt = sqlite_insert(VersaoDados).values(chave='saldos_compactados_ate', versao=dia.toordinal())
+    db.session.execute(stmt.on_conflict_do_update(index_elements=[VersaoDados.chave], set_={'versao': dia.toordinal()}))
+
+# Avança a marca só se ela ainda é a lida antes do lote (None = nunca compactado). É a primeira escrita
+# da transação, então a checagem já acontece com o lock de escrita do SQLite.
+def _avancar_compactado_ate(anterior, dia):
+    if anterior is None:
+        stmt = sqlite_insert(VersaoDados).values(chave='saldos_compactados_ate', versao=dia.toordinal())
+        return db.session.execute(stmt.on_conflict_do_nothing(index_elements=[VersaoDados.chave])).rowcount == 1
+    return db.session.execute(update(VersaoDados).where(
+        VersaoDados.chave == 'saldos_compactados_ate', VersaoDados.versao == anterior.toordinal()
+    ).values(versao=dia.toordinal())).rowcount == 1
+
+# Movimentos com data anterior ao que já foi compactado (ex.: importação em lote retroativa) invalidam
+# os saldos a partir daquele dia; a próxima compactação refaz só esse trecho.
+def invalidar_saldos_desde(dia):
+    compactado = saldos_compactados_ate()
+    if compactado is None or dia > compactado:
+        return
+    db.session.query(SaldoDiario).filter(SaldoDiario.dia >= dia).delete(synchronize_session=False)
+    _definir_compactado_ate(dia - timedelta(days=1))
+
+# Gera os saldos dos dias completos (até ontem) ainda não compactados, em lotes de dias.
+# Para cada lote: soma do dia por produto (GROUP BY) + saldo anterior, acumulado com SUM() OVER.
+# O cálculo é só leitura (no WAL não bloqueia ninguém); o lock de escrita fica só para gravar as linhas
+# prontas. Se uma importação retroativa baixou a marca nesse meio-tempo (invalidar_saldos_desde), o lote
+# foi calculado sobre saldos apagados: é descartado e a compactação recomeça da marca nova.
+def compactar_saldos(ate=None):
+    ate = ate or (datetime.utcnow().date() - timedelta(days=1))
+    dias = 0
+    while True:
+        marca = saldos_compactados_ate()
+        compactado = marca
+        if compactado is None:
+            primeiro = db.session.query(func.min(Movimento.timestamp)).scalar()
+            if primeiro is None:
+                return dias
+            compactado = primeiro.date() - timedelta(days=1)
+        if compactado >= ate:
+            return dias
+        inicio = compactado + timedelta(days=1)
+        fim = min(ate, compactado + timedelta(days=DIAS_POR_LOTE_COMPACTACAO))
+        saldos = db.session.execute(text("""
+            SELECT m.produto_id, m.dia,
+                   COALESCE((SELECT s.saldo FROM saldo_diario s
+                             WHERE s.produto_id = m.produto_id AND s.dia < :inicio
+                             ORDER BY s.dia DESC LIMIT 1), 0)
+                   + SUM(m.delta) OVER (PARTITION BY m.produto_id ORDER BY m.dia)
+            FROM (
+                SELECT produto_id, date(timestamp) AS dia,
+                       SUM(CASE WHEN tipo = 'entrada' THEN quantidade ELSE -quantidade END) AS delta
+                FROM movimento
+                WHERE tipo IN ('entrada', 'saida') AND timestamp >= :ts_inicio AND timestamp < :ts_fim
+                GROUP BY produto_id, date(timestamp)
+            ) m
+        """), {
+            'inicio': inicio.isoformat(),
+            'ts_inicio': datetime.combine(inicio, datetime.min.time()),
+            'ts_fim': datetime.combine(fim + timedelta(days=1), datetime.min.time()),
+        }).all()
+        if not _avancar_compactado_ate(marca, fim):
+            db.session.rollback()
+            continue
+        if saldos:
+            db.session.execute(text("INSERT OR REPLACE INTO saldo_diario (produto_id, dia, saldo) VALUES (:p, :d, :s)"),
+                               [{'p': p, 'd': d, 's': s} for p, d, s in saldos])
+        db.session.commit() # Um commit por lote: a compactação pode ser interrompida e retomada
+        dias += (fim - compactado).days
+
+# Estoque no fim do dia `dia` para um produto (int) ou para todos (dict produto_id -> saldo).
+def estoque_em(dia, produto_id=None):
+    compactado = saldos_compactados_ate()
+    base_dia = min(dia, compactado) if compactado else None
+    fim = datetime.combine(dia + timedelta(days=1), datetime.min.time())
+    inicio_delta = datetime.combine(base_dia + timedelta(days=1), datetime.min.time()) if base_dia else None
+
+    saldo_base = db.session.query(SaldoDiario.saldo).filter(
+        SaldoDiario.produto_id == Produto.id, SaldoDiario.dia <= base_dia
+    ).order_by(SaldoDiario.dia.desc()).limit(1).correlate(Produto).scalar_subquery() if base_dia else db.literal(0)
+    delta = db.session.query(
+        Movimento.produto_id, func.sum(_delta_movimento()).label('delta')
+    ).filter(Movimento.tipo.in_(TIPOS_MOVIMENTO), Movimento.timestamp < fim)
+    if inicio_delta:
+        delta = delta.filter(Movimento.timestamp >= inicio_delta)
+    if produto_id is not None:
+        delta = delta.filter(Movimento.produto_id == produto_id)
+    delta = delta.group_by(Movimento.produto_id).subquery()
+
+    query = db.session.query(
+        Produto.id, func.coalesce(saldo_base, 0) + func.coalesce(delta.c.delta, 0)
+    ).outerjoin(delta, delta.c.produto_id == Produto.id)
+    if produto_id is not None:
+        resultado = query.filter(Produto.id == produto_id).first()
+        return resultado[1] if resultado else None
+    return dict(query.all())
+
+# Série diária do estoque total (ou de um produto): saldo no início do período + soma acumulada
+# das variações diárias, sem reprocessar o ledger anterior ao período.
+def serie_estoque(dias=DIAS_GRAFICO_ESTOQUE, produto_id=None):
+    hoje = datetime.utcnow().date()
+    inicio = hoje - timedelta(days=dias - 1)
+    anterior = estoque_em(inicio - timedelta(days=1), produto_id)
+    saldo = (anterior or 0) if produto_id is not None else sum(anterior.values())
+    variacoes = db.session.query(
+        func.date(Movimento.timestamp), func.sum(_delta_movimento())
+    ).filter(Movimento.tipo.in_(TIPOS_MOVIMENTO), Movimento.timestamp >= datetime.combine(inicio, datetime.min.time()))
+    if produto_id is not None:
+        variacoes = variacoes.filter(Movimento.produto_id == produto_id)
+    variacoes = dict(variacoes.group_by(func.date(Movimento.timestamp)).all())
+    rotulos, valores = [], []
+    for i in range(dias):
+        dia = inicio + timedelta(days=i)
+        saldo += variacoes.get(dia.isoformat(), 0)
+        rotulos.append(dia.strftime('%d/%m'))
+        valores.append(saldo)
+    return rotulos, valores
+
+# Reconciliação: Produto.quantidade x ledger. Por padrão usa snapshot + delta; com completo=True
+# refaz a soma de todo o ledger (também serve para validar os próprios snapshots).
+def conferir_estoque(completo=False):
+    if completo:
+        soma = db.session.query(
+            Movimento.produto_id, func.sum(_delta_movimento()).label('saldo')
+        ).group_by(Movimento.produto_id).subquery()
+        ledger = dict(db.session.query(Produto.id, func.coalesce(soma.c.saldo, 0)).outerjoin(
+            soma, soma.c.produto_id == Produto.id).all())
+    else:
+        ledger = estoque_em(datetime.utcnow().date() + timedelta(days=1))
+    divergencias = []
+    for produto_id, nome, quantidade in db.session.query(Produto.id, Produto.nome, Produto.quantidade).yield_per(5000):
+        if (quantidade or 0) != ledger.get(produto_id, 0):
+            divergencias.append((produto_id, nome, quantidade, ledger.get(produto_id, 0)))
+    return divergencias
+
+# Um processo compacta por vez (workers do gunicorn e o cron): quem faz o UPDATE condicional fica com a
+# reserva até concluir ou até ela expirar, caso o processo morra no meio.
+RESERVA_COMPACTACAO_S = 1800
+
+def _reservar_compactacao():
+    agora = int(time.time())
+    db.session.execute(sqlite_insert(VersaoDados).values(chave='compactacao_reservada_ate', versao=0)
+                       .on_conflict_do_nothing(index_elements=[VersaoDados.chave]))
+    reservada = db.session.execute(update(VersaoDados).where(
+        VersaoDados.chave == 'compactacao_reservada_ate', VersaoDados.versao < agora
+    ).values(versao=agora + RESERVA_COMPACTACAO_S)).rowcount
+    db.session.commit()
+    return reservada == 1
+
+def _liberar_compactacao():
+    db.session.rollback()
+    db.session.execute(update(VersaoDados).where(VersaoDados.chave == 'compactacao_reservada_ate').values(versao=0))
+    db.session.commit()
+
+@app.cli.command('compactar-saldos')
+def compactar_saldos_comando():
+    """Gera os saldos diários pendentes (rode diariamente, ex.: via cron)."""
+    if not _reservar_compactacao():
+        print("Compactação já em andamento em outro processo.")
+        return
+    inicio = time.perf_counter()
+    try:
+        dias = compactar_saldos()
+    finally:
+        _liberar_compactacao()
+    print(f"{dias} dia(s) compactado(s) em {time.perf_counter() - inicio:.2f}s. Saldos completos até {saldos_compactados_ate()}.")
+
+@app.cli.command('conferir-estoque')
+@click.option('--completo', is_flag=True, help='Refaz a soma de todo o ledger em vez de usar os snapshots.')
+def conferir_estoque_comando(completo):
+    """Confere Produto.quantidade contra o ledger de movimentos."""
+    divergencias = conferir_estoque(completo)
+    for produto_id, nome, quantidade, ledger in divergencias:
+        print(f"Produto {produto_id} ({nome}): estoque {quantidade}, ledger {ledger} (diferença {(quantidade or 0) - ledger:+d})")
+    if divergencias:
+        print(f"{len(divergencias)} produto(s) com divergência.")
+        raise SystemExit(1)
+    print("OK: estoque confere com o ledger.")
+
+@app.route('/estoque/serie')
+@login_required
+@get_condicional(_dia_atual)
+def serie_estoque_json():
+    dias = min(max(request.args.get('dias', DIAS_GRAFICO_ESTOQUE, type=int), 1), 3660)
+    rotulos, valores = serie_estoque(dias, request.args.get('produto_id', type=int))
+    return jsonify({'labels': rotulos, 'data': valores})
+
+# --- ROTA DO DASHBOARD (CACHE INVALIDADO PELA VERSÃO DO ESTOQUE) ---
+LIMITE_ESTOQUE_BAIXO = 5
+DIAS_MAIS_MOVIMENTADOS = 30
+
+lock_compactacao = threading.Lock()
+
+# Dias já fechados ainda sem saldo (cron do compactar-saldos atrasado): a reconstrução do dashboard não
+# espera por eles, agenda a compactação no executor das tarefas e monta o gráfico com o que já existe.
+def agendar_compactacao_saldos():
+    ontem = datetime.utcnow().date() - timedelta(days=1)
+    if (saldos_compactados_ate() or date.min) >= ontem or not lock_compactacao.acquire(blocking=False):
+        return
+    def executar():
+        try:
+            with app.app_context():
+                if _reservar_compactacao():
+                    try:
+                        compactar_saldos(ontem)
+                    finally:
+                        _liberar_compactacao()
+        except Exception:
+            app.logger.exception("Falha na compactação dos saldos diários")
+        finally:
+            lock_compactacao.release()
+    executor_tarefas.submit(executar)
+
+def construir_dados_dashboard():
+    agendar_compactacao_saldos()
+    produtos_estoque = db.session.query(Produto.nome, Produto.quantidade).order_by(Produto.nome).all()
+    desde = datetime.utcnow() - timedelta(days=DIAS_MAIS_MOVIMENTADOS)
+    mais_movimentados = db.session.query(
+        Produto.nome, func.sum(Movimento.quantidade).label('total')
+    ).join(Produto, Movimento.produto_id == Produto.id).filter(
+        Movimento.tipo == 'saida', Movimento.timestamp >= desde
+    ).group_by(Movimento.produto_id, Produto.nome).order_by(func.sum(Movimento.quantidade).desc()).limit(10).all()
+    estoque_baixo, sem_estoque = db.session.query(
+        func.count(db.case((Produto.quantidade <= LIMITE_ESTOQUE_BAIXO, 1))),
+        func.count(db.case((Produto.quantidade <= 0, 1))),
+    ).one()
+    rotulos_serie, valores_serie = serie_estoque()
+    return {
+        'serie_labels': rotulos_serie,
+        'serie_data': valores_serie,
+        'labels': [nome for nome, _ in produtos_estoque],
+        'data': [quantidade for _, quantidade in produtos_estoque],
+        'mais_movimentados': [(nome, total) for nome, total in mais_movimentados],
+        'estoque_baixo': estoque_baixo,
+        'sem_estoque': sem_estoque,
+    }
+
+cache_dashboard = CacheVersionado(construir_dados_dashboard, validade_segundos=3600) # "Últimos N dias" depende do relógio
+
 @app.route('/dashboard')
 @login_required
+@get_condicional(_hora_atual) # Mesmo intervalo de validade do cache_dashboard ("últimos N dias")
 def dashboard():
-    produtos_estoque = Produto.query.order_by(Produto.nome).all()
-    labels = [p.nome for p in produtos_estoque]
-    data = [p.quantidade for p in produtos_estoque]
-    return render_template('dashboard.html', labels=labels, data=data)
+    dados = cache_dashboard.obter()
+    return render_template('dashboard.html', limite_estoque_baixo=LIMITE_ESTOQUE_BAIXO,
+                           dias_mais_movimentados=DIAS_MAIS_MOVIMENTADOS, dias_grafico_estoque=DIAS_GRAFICO_ESTOQUE, **dados)
+
+@app.route('/dashboard/cache')
+@login_required
+def dashboard_cache():
+    return jsonify(cache_dashboard.estatisticas())
 
 
 # --- ROTAS DE PRODUTO E INVENTÁRIO ---
@@ -134,11 +1028,12 @@ def adicionar_produto():
             if quantidade < 0 or not nome: raise ValueError
             novo_produto = Produto(nome=nome, quantidade=quantidade)
             db.session.add(novo_produto)
-            db.session.commit()
+            db.session.flush() # Gera o id sem encerrar a transação
             if quantidade > 0:
                 movimento_inicial = Movimento(produto_id=novo_produto.id, tipo='entrada', quantidade=quantidade)
                 db.session.add(movimento_inicial)
-                db.session.commit()
+            registrar_alteracao(novo_produto.id, nome)
+            db.session.commit()
             flash(f"Produto '{nome}' adicionado!", "success")
             return redirect(url_for('inventario'))
         except (ValueError, KeyError):
@@ -146,11 +1041,47 @@ def adicionar_produto():
             return redirect(url_for('adicionar_produto'))
     return render_template('adicionar_produto.html')
 
+# --- PAGINAÇÃO DO INVENTÁRIO (KEYSET) ---
+TAMANHO_PAGINA_INVENTARIO = 50
+
+# O cursor é o último id entregue; a próxima página começa depois dele (WHERE id > ?),
+# então o custo de cada página não depende de quantas já foram lidas (sem OFFSET).
+def buscar_pagina_produtos(termo='', apos=None, limite=TAMANHO_PAGINA_INVENTARIO):
+    query = Produto.query
+    if termo:
+        filtro = Produto.nome.ilike(f"%{termo}%")
+        if termo.isdigit():
+            filtro = filtro | (Produto.id == int(termo)) # Permite buscar pelo código
+        query = query.filter(filtro)
+    if apos is not None:
+        query = query.filter(Produto.id > apos)
+    # Busca um item a mais só para saber se existe próxima página
+    produtos = query.order_by(Produto.id).limit(limite + 1).all()
+    proximo_cursor = None
+    if len(produtos) > limite:
+        produtos = produtos[:limite]
+        proximo_cursor = produtos[-1].id
+    return produtos, proximo_cursor
+
 @app.route('/inventario')
 @login_required
+@get_condicional()
 def inventario():
-    estoque_db = Produto.query.order_by(Produto.id).all() # Ordenar por ID pode ser melhor para consistência
-    return render_template('index.html', estoque=estoque_db)
+    termo = request.args.get('q', '').strip()
+    apos = request.args.get('apos', type=int)
+    estoque_db, proximo_cursor = buscar_pagina_produtos(termo, apos)
+    if 'HX-Request' in request.headers:
+        # Busca e "carregar mais" só precisam das linhas da tabela
+        return render_template('_pagina_produtos.html', estoque=estoque_db, proximo_cursor=proximo_cursor, termo=termo)
+    return render_template('index.html', estoque=estoque_db, proximo_cursor=proximo_cursor, termo=termo)
+
+# --- AUTOCOMPLETE DE PRODUTOS (HTMX) ---
+@app.route('/produtos/buscar')
+@login_required
+def buscar_produtos():
+    termo = request.args.get('q', '').strip()
+    sugestoes = indice_produtos.buscar(termo) if termo else []
+    return render_template('_sugestoes_produtos.html', sugestoes=sugestoes, termo=termo)
 
 # --- ROTA HELPER PARA ATUALIZAR O TARGET DO FORM HTMX ---
 @app.route('/get-product-row-target', methods=['POST'])
@@ -168,73 +1099,428 @@ def get_product_row_target():
     # response.headers['HX-Reswap'] = 'outerHTML' 
     return response
 
+# --- MOVIMENTAÇÃO ATÔMICA ---
+# A baixa/entrada é um único UPDATE condicional (quantidade = quantidade - ? WHERE id = ? AND quantidade >= ?)
+# na mesma transação do INSERT do Movimento. Não há leitura-verificação-escrita em Python, então dois
+# workers do gunicorn não conseguem passar juntos pela checagem de estoque nem sobrescrever a baixa um do outro.
+def registrar_movimento(produto_id, tipo, quantidade):
+    if quantidade <= 0: raise ValueError("Quantidade deve ser maior que zero.")
+
+    if tipo == 'entrada':
+        stmt = update(Produto).where(Produto.id == produto_id).values(quantidade=Produto.quantidade + quantidade)
+    elif tipo == 'saida':
+        stmt = update(Produto).where(
+            Produto.id == produto_id, Produto.quantidade >= quantidade
+        ).values(quantidade=Produto.quantidade - quantidade)
+    else:
+         raise ValueError("Tipo de movimento inválido.")
+
+    resultado = db.session.execute(stmt.execution_options(synchronize_session=False))
+    if resultado.rowcount == 0:
+        # Nenhuma linha alterada: ou o produto não existe ou não há estoque suficiente
+        db.session.rollback()
+        produto = db.session.get(Produto, produto_id)
+        if not produto: raise ValueError(f"Produto com código {produto_id} não encontrado.")
+        raise ValueError(f'Estoque insuficiente para {produto.nome}. ({produto.quantidade} em estoque)')
+
+    db.session.add(Movimento(produto_id=produto_id, tipo=tipo, quantidade=quantidade))
+    registrar_alteracoes_estoque([produto_id])
+    db.session.commit()
+    return db.session.get(Produto, produto_id) # Recarregado após o commit (expire_on_commit)
+
+# Worker do teste de estresse: simula um processo do gunicorn fazendo movimentações no mesmo produto.
+def _worker_estresse(produto_id, operacoes, semente):
+    import random
+    rng = random.Random(semente)
+    db.engine.dispose(close=False) # Conexões herdadas do fork não podem ser reutilizadas
+    entradas = saidas = recusadas = 0
+    with app.app_context():
+        for _ in range(operacoes):
+            tipo = rng.choice(['entrada', 'saida', 'saida'])
+            quantidade = rng.randint(1, 5)
+            try:
+                registrar_movimento(produto_id, tipo, quantidade)
+            except ValueError:
+                recusadas += 1 # Estoque insuficiente: esperado, a checagem é atômica
+                continue
+            if tipo == 'entrada': entradas += quantidade
+            else: saidas += quantidade
+        db.session.remove()
+    return entradas, saidas, recusadas
+
+@app.cli.command('estresse-movimentos')
+@click.option('--workers', default=8, show_default=True, help='Processos concorrentes.')
+@click.option('--operacoes', default=200, show_default=True, help='Movimentações por processo.')
+@click.option('--estoque-inicial', default=50, show_default=True)
+def estresse_movimentos_comando(workers, operacoes, estoque_inicial):
+    """Martela um produto com movimentações concorrentes e confere estoque x ledger."""
+    import multiprocessing
+    # A exclusão do produto de teste fica registrada no histórico em nome do admin (ou do primeiro usuário)
+    usuario = Usuario.query.filter_by(username='admin').first() or Usuario.query.first()
+    if not usuario:
+        print("Nenhum usuário cadastrado: rode 'flask inicializar' antes.")
+        raise SystemExit(1)
+    user_id = usuario.id
+    produto = Produto(nome='__teste_concorrencia__', quantidade=0)
+    db.session.add(produto)
+    db.session.commit()
+    produto_id = produto.id
+    registrar_movimento(produto_id, 'entrada', estoque_inicial)
+    db.session.remove()
+
+    inicio = time.perf_counter()
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+        resultados = pool.starmap(_worker_estresse, [(produto_id, operacoes, i) for i in range(workers)])
+    duracao = time.perf_counter() - inicio
+
+    entradas = estoque_inicial + sum(r[0] for r in resultados)
+    saidas = sum(r[1] for r in resultados)
+    recusadas = sum(r[2] for r in resultados)
+    estoque = db.session.get(Produto, produto_id).quantidade
+    soma_ledger = db.session.query(func.coalesce(func.sum(
+        db.case((Movimento.tipo == 'entrada', Movimento.quantidade), else_=-Movimento.quantidade)
+    ), 0)).filter(Movimento.produto_id == produto_id).scalar()
+
+    print(f"{workers * operacoes} operações em {duracao:.2f}s ({recusadas} recusadas por falta de estoque)")
+    print(f"Estoque final: {estoque} | Ledger: {soma_ledger} | Esperado pelos workers: {entradas - saidas}")
+
+    # Mesmo caminho da exclusão em lote: grava a remoção no log de alterações e invalida os caches
+    excluir_produtos_em_lote([produto_id], user_id)
+
+    if estoque < 0 or estoque != soma_ledger or estoque != entradas - saidas:
+        print("FALHA: estoque e ledger divergem.")
+        raise SystemExit(1)
+    print("OK: estoque confere com o ledger.")
+
+# --- ATUALIZAÇÕES AO VIVO DO INVENTÁRIO (SERVER-SENT EVENTS) ---
+# Uma thread por worker lê o log AlteracaoProduto e acorda as conexões SSE abertas: o custo no banco é
+# uma consulta por intervalo, não por cliente, e cada linha alterada é renderizada uma vez por worker.
+# Uma conexão ociosa é só uma thread parada numa Condition, por isso o gunicorn roda com workers em
+# thread (gunicorn.conf.py); com workers sync cada tela aberta ocuparia um processo inteiro.
+# As threads são as mesmas das requisições comuns: no máximo CONEXOES_SSE_POR_WORKER streams por worker
+# (metade das threads, por padrão), para que telas ociosas nunca ocupem o worker inteiro. Acima disso a
+# tela funciona normalmente, só sem atualização ao vivo. Mais telas abertas: aumente STOCKIFY_THREADS.
+INTERVALO_EVENTOS_S = 0.5
+BATIMENTO_SSE_S = 15        # Comentário periódico para proxies não derrubarem a conexão ociosa
+DURACAO_MAXIMA_SSE_S = 600  # Depois disso a conexão é fechada e o navegador reconecta (retry + Last-Event-ID)
+EVENTOS_EM_MEMORIA = 2000
+FRAGMENTOS_EM_CACHE = 5000
+CONEXOES_SSE_POR_WORKER = int(os.environ.get('STOCKIFY_SSE_POR_WORKER', THREADS_POR_WORKER // 2))
+vagas_sse = threading.BoundedSemaphore(CONEXOES_SSE_POR_WORKER)
+
+class TransmissorEventos:
+    def __init__(self):
+        self.condicao = threading.Condition()
+        self.eventos = collections.deque(maxlen=EVENTOS_EM_MEMORIA) # (id da alteração, produto_id)
+        self.ultimo_id = None
+        self.base_id = None # Toda alteração com id > base_id está em self.eventos
+        self.fragmentos = {} # (produto_id, id da alteração) -> HTML da linha
+        self.thread = None
+
+    # Inicia a leitura do log na primeira conexão SSE do worker
+    def iniciar(self):
+        with self.condicao:
+            if self.ultimo_id is None:
+                self.ultimo_id = db.session.query(func.coalesce(func.max(AlteracaoProduto.id), 0)).scalar()
+                self.base_id = self.ultimo_id
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._executar, name='transmissor-eventos', daemon=True)
+                self.thread.start()
+
+    def _executar(self):
+        with app.app_context():
+            while True:
+                try:
+                    novos = db.session.query(AlteracaoProduto.id, AlteracaoProduto.produto_id).filter(
+                        AlteracaoProduto.id > self.ultimo_id
+                    ).order_by(AlteracaoProduto.id).limit(EVENTOS_EM_MEMORIA).all()
+                    if novos:
+                        with self.condicao:
+                            self.eventos.extend(novos)
+                            self.ultimo_id = novos[-1][0]
+                            if len(self.eventos) == self.eventos.maxlen: # Os mais antigos saíram da fila
+                                self.base_id = max(self.base_id, self.eventos[0][0] - 1)
+                            self.condicao.notify_all()
+                except Exception:
+                    app.logger.exception("Falha ao ler o log de alterações para os eventos SSE")
+                finally:
+                    db.session.remove() # Não mantém transação de leitura aberta entre as consultas
+                time.sleep(INTERVALO_EVENTOS_S)
+
+    # Eventos com id > apos_id, esperando até `timeout` segundos se ainda não houver nenhum.
+    # None se apos_id é anterior ao que está em memória (reconexão tardia, Last-Event-ID de outro
+    # worker): as alterações do intervalo se perderam e o cliente precisa recarregar a tabela.
+    def esperar(self, apos_id, timeout):
+        with self.condicao:
+            if apos_id < self.base_id:
+                return None
+            self.condicao.wait_for(lambda: self.ultimo_id > apos_id, timeout)
+            return [evento for evento in self.eventos if evento[0] > apos_id]
+
+    # HTML das linhas alteradas; só o que não está no cache vai ao banco (numa consulta)
+    def renderizar(self, alteracoes):
+        fragmentos = {pid: self.fragmentos.get((pid, alteracao_id)) for pid, alteracao_id in alteracoes.items()}
+        faltando = [pid for pid, html in fragmentos.items() if html is None]
+        if faltando:
+            produtos = {p.id: p for p in Produto.query.filter(Produto.id.in_(faltando))}
+            if len(self.fragmentos) > FRAGMENTOS_EM_CACHE:
+                self.fragmentos = {}
+            for pid in faltando:
+                produto = produtos.get(pid)
+                # Produto excluído: um comentário no lugar da linha faz o outerHTML remover a linha
+                fragmentos[pid] = render_template('_linha_produto.html', produto=produto) if produto else '<!-- produto excluído -->'
+                self.fragmentos[(pid, alteracoes[pid])] = fragmentos[pid]
+        return list(fragmentos.items())
+
+transmissor_eventos = TransmissorEventos()
+
+def formatar_evento_sse(evento, dados, evento_id=None):
+    linhas = [f"id: {evento_id}"] if evento_id is not None else []
+    linhas.append(f"event: {evento}")
+    linhas.extend(f"data: {linha}" for linha in dados.splitlines() or [''])
+    return '\n'.join(linhas) + '\n\n'
+
+# Cada linha do inventário escuta "produto-<id>" (sse-swap) e é trocada pelo fragmento novo
+@app.route('/eventos/inventario')
+@login_required
+def eventos_inventario():
+    if not vagas_sse.acquire(blocking=False):
+        return Response(status=204) # 204 faz o EventSource desistir em vez de reconectar em laço
+    try:
+        transmissor_eventos.iniciar()
+    except Exception:
+        vagas_sse.release()
+        raise
+    ultimo_id = request.headers.get('Last-Event-ID', type=int)
+    if ultimo_id is None:
+        ultimo_id = transmissor_eventos.ultimo_id
+    db.session.close() # A conexão não fica presa à requisição enquanto o stream estiver aberto
+
+    def gerar(ultimo_id):
+        yield f"retry: 3000\n\n"
+        fim = time.monotonic() + DURACAO_MAXIMA_SSE_S
+        while time.monotonic() < fim:
+            eventos = transmissor_eventos.esperar(ultimo_id, BATIMENTO_SSE_S)
+            if eventos is None:
+                # Cursor velho demais: avança para o fim do log e pede ao cliente a tabela inteira
+                ultimo_id = transmissor_eventos.ultimo_id
+                yield formatar_evento_sse("recarregar", "", ultimo_id)
+                continue
+            if not eventos:
+                yield ": ping\n\n"
+                continue
+            ultimo_id = eventos[-1][0]
+            alteracoes = {} # produto_id -> última alteração; várias mudanças no mesmo produto viram um evento
+            for alteracao_id, produto_id in eventos:
+                alteracoes[produto_id] = alteracao_id
+            fragmentos = transmissor_eventos.renderizar(alteracoes)
+            db.session.close()
+            yield ''.join(formatar_evento_sse(f"produto-{pid}", html, ultimo_id) for pid, html in fragmentos)
+
+    resposta = Response(stream_with_context(gerar(ultimo_id)), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    resposta.call_on_close(vagas_sse.release) # Chamado pelo servidor ao fim do stream ou na desconexão
+    return resposta
+
 # --- ROTA DE MOVIMENTAÇÃO ATUALIZADA PARA HTMX ---
 @app.route('/movimentar', methods=['POST'])
 @login_required
 def movimentar():
     produto_id_str = request.form.get('codigo', '').strip()
-    produto = None
+    produto_id = None
     is_htmx = 'HX-Request' in request.headers
 
     try:
         if not produto_id_str.isdigit():
              raise ValueError("Código do produto inválido.")
         produto_id = int(produto_id_str)
-        produto = db.session.get(Produto, produto_id) # Usar db.session.get é mais eficiente
         quantidade = int(request.form['quantidade'])
         tipo = request.form['tipo_movimento']
-        
-        if not produto: raise ValueError(f"Produto com código {produto_id} não encontrado.")
-        if quantidade <= 0: raise ValueError("Quantidade deve ser maior que zero.")
-
-        if tipo == 'entrada':
-            produto.quantidade += quantidade
-        elif tipo == 'saida':
-            if produto.quantidade < quantidade:
-                raise ValueError(f'Estoque insuficiente para {produto.nome}. ({produto.quantidade} em estoque)')
-            produto.quantidade -= quantidade
-        else:
-             raise ValueError("Tipo de movimento inválido.")
-        
-        novo_movimento = Movimento(produto_id=produto.id, tipo=tipo, quantidade=quantidade)
-        db.session.add(novo_movimento)
-        db.session.commit()
+
+        produto = registrar_movimento(produto_id, tipo, quantidade)
         
         # Flash sempre é útil, mesmo que só apareça no próximo load completo
         flash(f"Movimentação de {tipo} registrada para {produto.nome} ({quantidade} unidades).", "success")
 
         if is_htmx:
             # Retorna APENAS o HTML da linha da tabela atualizada
-            return render_template('_linha_produto.html', produto=produto)
+            response = make_response(render_template('_linha_produto.html', produto=produto))
+            response.headers['HX-Retarget'] = f"#linha-produto-{produto.id}"
+            response.headers['HX-Reswap'] = 'outerHTML'
+            return response
         else:
             return redirect(url_for('inventario'))
 
     except (ValueError, KeyError, TypeError) as e:
         error_message = str(e) or 'Dados inválidos para movimentação.'
         flash(error_message, 'danger') # Mostra o erro
+        db.session.rollback() # Desfaz qualquer mudança não commitada
+        # Recarrega o produto do DB para devolver a linha como está de fato
+        produto_atual = db.session.get(Produto, produto_id) if produto_id is not None else None
 
-        if is_htmx and produto:
+        if is_htmx and produto_atual:
              # Se deu erro mas o produto existe (ex: estoque insuficiente), 
-             # retorna a linha como estava ANTES da tentativa de commit.
-             # Precisamos recarregar o produto do DB para ter certeza do estado original
-             db.session.rollback() # Desfaz qualquer mudança não commitada
-             produto_atual = db.session.get(Produto, produto_id)
+             # retorna a linha com o estado atual do banco.
              # Usa um header especial para exibir o flash via JS (requer JS no frontend)
              response = make_response(render_template('_linha_produto.html', produto=produto_atual))
+             response.headers['HX-Retarget'] = f"#linha-produto-{produto_atual.id}"
+             response.headers['HX-Reswap'] = 'outerHTML'
              response.headers['HX-Trigger'] = '{"showFlash": "true"}' # Sinaliza para mostrar flash
              return response, 422 # Código de erro (Unprocessable Entity)
         elif is_htmx:
             # Se o produto nem foi encontrado ou outro erro grave
-            db.session.rollback()
             # Retorna um fragmento vazio ou uma mensagem de erro direta
             response = make_response(f"<div id='linha-produto-{produto_id_str or 0}'></div>", 404 if "não encontrado" in error_message else 400) # 404 ou 400
             response.headers['HX-Trigger'] = '{"showFlash": "true"}'
             return response
         else: # Requisição normal
-            db.session.rollback()
             return redirect(url_for('inventario'))
 
 
+# --- MOVIMENTAÇÃO EM LOTE (CSV / JSONL) ---
+# Colunas aceitas: codigo, tipo, quantidade e (opcional) timestamp em ISO 8601.
+CAMPOS_LOTE = ['codigo', 'tipo', 'quantidade', 'timestamp']
+TAMANHO_BLOCO_IN = 500 # Limita o número de parâmetros por consulta IN no SQLite
+
+# Lê o arquivo linha a linha e devolve (numero_da_linha, dict). JSONL é detectado pela extensão
+# ou por começar com '{'; caso contrário é tratado como CSV com cabeçalho.
+def ler_linhas_lote(arquivo_texto, nome_arquivo=''):
+    primeira = arquivo_texto.readline()
+    if nome_arquivo.lower().endswith('.jsonl') or primeira.lstrip().startswith('{'):
+        for numero, linha in enumerate(itertools.chain([primeira], arquivo_texto), start=1):
+            if not linha.strip():
+                continue
+            try:
+                dados = json.loads(linha)
+            except ValueError:
+                dados = None
+            yield numero, dados if isinstance(dados, dict) else None
+    else:
+        leitor = csv.DictReader(itertools.chain([primeira], arquivo_texto))
+        for numero, dados in enumerate(leitor, start=2): # Linha 1 é o cabeçalho
+            yield numero, dados
+
+def _validar_linha_lote(dados):
+    if dados is None: raise ValueError("Linha mal formatada.")
+    codigo = str(dados.get('codigo') or '').strip()
+    if not codigo.isdigit(): raise ValueError("Código do produto inválido.")
+    tipo = str(dados.get('tipo') or '').strip().lower()
+    if tipo not in ('entrada', 'saida'): raise ValueError("Tipo de movimento inválido.")
+    try:
+        quantidade = int(dados.get('quantidade'))
+    except (TypeError, ValueError):
+        raise ValueError("Quantidade inválida.")
+    if quantidade <= 0: raise ValueError("Quantidade deve ser maior que zero.")
+    timestamp_str = str(dados.get('timestamp') or '').strip()
+    agora = datetime.utcnow()
+    try:
+        timestamp = datetime.fromisoformat(timestamp_str) if timestamp_str else agora
+    except ValueError:
+        raise ValueError("Timestamp inválido. Use ISO 8601 (AAAA-MM-DDTHH:MM:SS).")
+    # Com fuso (ex.: ...-03:00 ou Z), converte para UTC sem tzinfo, como o resto do banco
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    if timestamp > agora: raise ValueError("Timestamp no futuro não é permitido.")
+    return int(codigo), tipo, quantidade, timestamp
+
+# Valida todas as linhas numa única passada contra o estoque atual (simulando a sequência do arquivo)
+# e aplica tudo numa transação: um UPDATE por produto com o saldo líquido e os INSERTs de Movimento
+# via executemany. Com parcial=False, qualquer erro cancela o lote inteiro.
+def importar_movimentos_lote(linhas, parcial=False):
+    inicio = time.perf_counter()
+    validas, erros = [], []
+    for numero, dados in linhas:
+        try:
+            validas.append((numero,) + _validar_linha_lote(dados))
+        except ValueError as e:
+            erros.append((numero, str(e)))
+    total = len(validas) + len(erros)
+
+    # Estoque atual de todos os produtos citados, em poucas consultas IN
+    ids = sorted({linha[1] for linha in validas})
+    estoque = {}
+    for i in range(0, len(ids), TAMANHO_BLOCO_IN):
+        bloco = ids[i:i + TAMANHO_BLOCO_IN]
+        estoque.update(db.session.query(Produto.id, Produto.quantidade).filter(Produto.id.in_(bloco)).all())
+
+    saldo_inicial = dict(estoque)
+    movimentos = []
+    for numero, produto_id, tipo, quantidade, timestamp in validas:
+        if produto_id not in estoque:
+            erros.append((numero, f"Produto com código {produto_id} não encontrado."))
+            continue
+        if tipo == 'saida' and estoque[produto_id] < quantidade:
+            erros.append((numero, f"Estoque insuficiente para o produto {produto_id}. ({estoque[produto_id]} em estoque)"))
+            continue
+        estoque[produto_id] += quantidade if tipo == 'entrada' else -quantidade
+        movimentos.append({'produto_id': produto_id, 'tipo': tipo, 'quantidade': quantidade, 'timestamp': timestamp})
+    erros.sort()
+
+    aplicadas = 0
+    if movimentos and (parcial or not erros):
+        variacoes = [
+            {'pid': pid, 'delta': estoque[pid] - saldo_inicial[pid]}
+            for pid in estoque if estoque[pid] != saldo_inicial[pid]
+        ]
+        try:
+            if variacoes:
+                # Condicional como em registrar_movimento: se outro worker baixou estoque entre a
+                # validação e este UPDATE, o saldo não pode ficar negativo e o lote é cancelado.
+                resultado = db.session.execute(
+                    text("UPDATE produto SET quantidade = quantidade + :delta WHERE id = :pid AND quantidade + :delta >= 0"),
+                    variacoes
+                )
+                if resultado.rowcount != len(variacoes):
+                    raise ValueError("O estoque mudou durante a importação. Nenhuma linha foi aplicada; tente novamente.")
+            db.session.execute(insert(Movimento), movimentos)
+            invalidar_saldos_desde(min(m['timestamp'] for m in movimentos).date()) # Só tem efeito se for retroativo
+            registrar_alteracoes_estoque([v['pid'] for v in variacoes])
+            db.session.commit()
+            aplicadas = len(movimentos)
+        except ValueError as e:
+            db.session.rollback()
+            erros.append((0, str(e)))
+
+    duracao = time.perf_counter() - inicio
+    return {
+        'total': total,
+        'aplicadas': aplicadas,
+        'erros': erros,
+        'segundos': duracao,
+        'linhas_por_segundo': total / duracao if duracao > 0 else 0.0,
+    }
+
+@app.route('/movimentar/lote', methods=['GET', 'POST'])
+@login_required
+def movimentar_lote():
+    resultado = None
+    if request.method == 'POST':
+        arquivo = request.files.get('arquivo')
+        if not arquivo or not arquivo.filename:
+            flash("Selecione um arquivo CSV ou JSONL.", "danger")
+            return redirect(url_for('movimentar_lote'))
+        texto = io.TextIOWrapper(arquivo.stream, encoding='utf-8-sig')
+        resultado = importar_movimentos_lote(ler_linhas_lote(texto, arquivo.filename), parcial='parcial' in request.form)
+        if resultado['aplicadas']:
+            flash(f"{resultado['aplicadas']} movimentações aplicadas.", "success")
+        if resultado['erros']:
+            flash(f"{len(resultado['erros'])} linhas com erro.", "danger")
+    return render_template('movimentar_lote.html', resultado=resultado)
+
+@app.cli.command('importar-movimentos')
+@click.argument('arquivo', type=click.Path(exists=True, dir_okay=False))
+@click.option('--parcial', is_flag=True, help='Aplica as linhas válidas mesmo se houver erros.')
+def importar_movimentos_comando(arquivo, parcial):
+    """Importa entradas/saídas em lote de um arquivo CSV ou JSONL."""
+    with open(arquivo, encoding='utf-8-sig', newline='') as f:
+        resultado = importar_movimentos_lote(ler_linhas_lote(f, arquivo), parcial=parcial)
+    for numero, mensagem in resultado['erros']:
+        print(f"Linha {numero}: {mensagem}" if numero else mensagem)
+    print(f"{resultado['aplicadas']}/{resultado['total']} linhas aplicadas em {resultado['segundos']:.3f}s "
+          f"({resultado['linhas_por_segundo']:.0f} linhas/s)")
+    if resultado['erros']:
+        raise SystemExit(1)
+
 # --- ROTA EDITAR NOME ATUALIZADA PARA SALVAR HISTÓRICO ---
 @app.route('/editar_nome', methods=['POST'])
 @login_required
@@ -263,7 +1549,14 @@ def editar_nome():
                 valor_novo=novo_nome
             )
             db.session.add(historico) 
+            registrar_alteracao(produto.id, novo_nome)
             db.session.commit() 
+            if 'HX-Request' in request.headers:
+                # Só a linha editada volta; as outras telas recebem a mesma linha pelo SSE
+                response = make_response(render_template('_linha_produto.html', produto=produto))
+                response.headers['HX-Retarget'] = f"#linha-produto-{produto.id}"
+                response.headers['HX-Reswap'] = 'outerHTML'
+                return response
             flash("Nome do produto atualizado com sucesso!", "success")
         else: # Novo nome é igual ao antigo
              flash("O novo nome é igual ao nome atual.", "info")
@@ -271,7 +1564,11 @@ def editar_nome():
     except (ValueError, KeyError):
         flash("Erro ao processar a edição.", "danger")
         db.session.rollback() # Desfaz em caso de erro
-        
+
+    if 'HX-Request' in request.headers:
+        response = make_response("", 204)
+        response.headers['HX-Trigger'] = '{"showFlash": "true"}'
+        return response
     return redirect(url_for('inventario'))
 
 
@@ -296,6 +1593,7 @@ def excluir_produto():
                 valor_novo='-'
             )
             db.session.add(historico_exclusao)
+            registrar_alteracao(produto.id, None)
 
             db.session.delete(produto)
             db.session.commit()
@@ -326,16 +1624,15 @@ def excluir_produto_htmx(produto_id):
                 valor_novo='-'
             )
             db.session.add(historico_exclusao)
+            registrar_alteracao(produto.id, None)
             
             # Cascade deve cuidar da exclusão dos movimentos
             db.session.delete(produto)
             db.session.commit()
-            flash(f"Produto '{nome_produto_excluido}' excluído com sucesso.", "success")
-            
-            # Resposta vazia indica sucesso para o HTMX remover a linha
-            response = make_response("", 200)
-            response.headers['HX-Trigger'] = '{"showFlash": "true"}' # Avisa para mostrar flash
-            return response
+
+            # Resposta vazia indica sucesso para o HTMX remover a linha; sem flash/showFlash, que faria o
+            # scripts.js recarregar a página inteira (as outras telas já recebem a remoção por SSE)
+            return make_response("", 200)
         else:
              # Se o produto não existe (talvez já excluído), retorna 404
              flash("Produto não encontrado.", "warning")
@@ -350,28 +1647,220 @@ def excluir_produto_htmx(produto_id):
         response.headers['HX-Trigger'] = '{"showFlash": "true"}'
         return response
 
+# --- EXCLUSÃO EM LOTE ---
+# Registra histórico e log de alterações com INSERT ... SELECT e apaga tudo com um único DELETE;
+# movimentos e itens da lista de pedidos saem pelo ON DELETE CASCADE do banco.
+def excluir_produtos_em_lote(produto_ids, user_id):
+    excluidos = 0
+    for i in range(0, len(produto_ids), TAMANHO_BLOCO_IN):
+        bloco = produto_ids[i:i + TAMANHO_BLOCO_IN]
+        db.session.execute(insert(EditHistory).from_select(
+            ['produto_id', 'user_id', 'campo_alterado', 'nome_produto_na_epoca', 'valor_antigo', 'valor_novo', 'timestamp'],
+            db.select(Produto.id, db.literal(user_id), db.literal('exclusao'), Produto.nome, Produto.nome,
+                      db.literal('-'), db.literal(datetime.utcnow())).where(Produto.id.in_(bloco))
+        ))
+        db.session.execute(insert(AlteracaoProduto).from_select(
+            ['produto_id', 'nome', 'timestamp'],
+            db.select(Produto.id, db.literal(None, db.String), db.literal(datetime.utcnow())).where(Produto.id.in_(bloco))
+        ))
+        resultado = db.session.execute(db.delete(Produto).where(Produto.id.in_(bloco)).execution_options(synchronize_session=False))
+        excluidos += resultado.rowcount
+    if excluidos:
+        incrementar_versao_estoque()
+    db.session.commit()
+    return excluidos
+
+@app.route('/excluir-produtos', methods=['POST'])
+@login_required
+def excluir_produtos():
+    try:
+        codigos = request.form['codigos'].replace(',', ' ').split()
+        produto_ids = sorted({int(c) for c in codigos})
+        if not produto_ids: raise ValueError
+        excluidos = excluir_produtos_em_lote(produto_ids, current_user.id)
+        flash(f"{excluidos} produto(s) e seus históricos de movimentação foram excluídos.", "success" if excluidos else "warning")
+    except (ValueError, KeyError):
+        flash("Informe os códigos dos produtos separados por vírgula ou espaço.", "danger")
+        db.session.rollback()
+    return redirect(url_for('inventario'))
+
+# --- PREVISÃO DE DEMANDA E SUGESTÃO DE REPOSIÇÃO ---
+# Consumo diário de cada produto = média das saídas dos últimos JANELA_PREVISAO_DIAS dias com peso
+# exponencial (meia-vida MEIA_VIDA_CONSUMO_DIAS), calculada para o catálogo inteiro de uma vez com numpy:
+# o SQLite só entrega as saídas da janela. Estoque alvo = consumo * (prazo + cobertura alvo)
+# + estoque de segurança (z * desvio * raiz do prazo); a sugestão é o que falta para chegar nele.
+# Ao longo do dia só são recalculados os produtos com movimentos novos; na virada do dia, todos
+# (em segundo plano quando a virada é percebida por uma requisição, ou pelo cron do atualizar-previsoes).
+JANELA_PREVISAO_DIAS = 90
+MEIA_VIDA_CONSUMO_DIAS = 30
+PRAZO_REPOSICAO_DIAS = 7
+COBERTURA_ALVO_DIAS = 30
+NIVEL_SERVICO = 0.95
+Z_NIVEL_SERVICO = statistics.NormalDist().inv_cdf(NIVEL_SERVICO)
+MAX_PRODUTOS_INCREMENTAL = 5000 # Acima disso um recálculo completo sai mais barato
+SUGESTOES_NA_PAGINA = 50
+
+def _ler_array(sql, parametros, tipos):
+    cursor = db.session.execute(text(sql), parametros).cursor
+    return np.fromiter(cursor, dtype=tipos)
+
+def calcular_previsoes(produto_ids=None):
+    hoje = datetime.utcnow().date()
+    inicio = hoje - timedelta(days=JANELA_PREVISAO_DIAS - 1)
+    filtro_ids = f" AND {{coluna}} IN ({', '.join(str(int(pid)) for pid in produto_ids)})" if produto_ids is not None else ''
+    produtos = _ler_array(
+        "SELECT id, quantidade FROM produto WHERE 1 = 1" + filtro_ids.format(coluna='id') + " ORDER BY id",
+        {}, [('id', 'i8'), ('quantidade', 'f8')])
+    # Catálogo inteiro: o planejador tende a varrer ix_movimento_produto_timestamp produto a produto;
+    # pelo índice de tipo + período a leitura é sequencial. Poucos produtos: o índice por produto é o certo.
+    # O limite superior deixa de fora movimentos com data futura (dias_atras negativo).
+    indice = " INDEXED BY ix_movimento_tipo_timestamp" if produto_ids is None else ''
+    saidas = _ler_array(
+        "SELECT produto_id, CAST(julianday(:hoje) - julianday(date(timestamp)) AS INTEGER), quantidade"
+        " FROM movimento" + indice + " WHERE tipo = 'saida' AND timestamp >= :inicio AND timestamp < :amanha" + filtro_ids.format(coluna='produto_id'),
+        {'hoje': hoje.isoformat(), 'inicio': datetime.combine(inicio, datetime.min.time()),
+         'amanha': datetime.combine(hoje + timedelta(days=1), datetime.min.time())},
+        [('produto_id', 'i8'), ('dias_atras', 'i8'), ('quantidade', 'f8')])
+
+    n = len(produtos)
+    posicao = np.searchsorted(produtos['id'], saidas['produto_id'])
+    validas = (posicao < n) & (produtos['id'][np.minimum(posicao, n - 1)] == saidas['produto_id']) if n else np.zeros(len(saidas), bool)
+    validas &= (saidas['dias_atras'] >= 0) & (saidas['dias_atras'] < JANELA_PREVISAO_DIAS)
+    # Soma por produto e dia (a variância é do consumo diário, não de cada movimento)
+    chaves, inversa = np.unique(posicao[validas] * JANELA_PREVISAO_DIAS + saidas['dias_atras'][validas], return_inverse=True)
+    quantidade = np.bincount(inversa, weights=saidas['quantidade'][validas], minlength=len(chaves))
+    posicao, dias_atras = chaves // JANELA_PREVISAO_DIAS, chaves % JANELA_PREVISAO_DIAS
+
+    # Médias ponderadas sobre todos os dias da janela (dias sem saída contam como zero)
+    pesos = 0.5 ** (dias_atras / MEIA_VIDA_CONSUMO_DIAS)
+    soma_pesos = (0.5 ** (np.arange(JANELA_PREVISAO_DIAS) / MEIA_VIDA_CONSUMO_DIAS)).sum()
+    consumo = np.bincount(posicao, weights=pesos * quantidade, minlength=n) / soma_pesos
+    segundo_momento = np.bincount(posicao, weights=pesos * quantidade ** 2, minlength=n) / soma_pesos
+    desvio = np.sqrt(np.maximum(segundo_momento - consumo ** 2, 0))
+
+    estoque = np.maximum(produtos['quantidade'], 0)
+    com_consumo = consumo > 0
+    cobertura = np.divide(estoque, consumo, out=np.zeros(n), where=com_consumo)
+    estoque_alvo = consumo * (PRAZO_REPOSICAO_DIAS + COBERTURA_ALVO_DIAS) + Z_NIVEL_SERVICO * desvio * np.sqrt(PRAZO_REPOSICAO_DIAS)
+    sugestao = np.ceil(np.maximum(estoque_alvo - estoque, 0)).astype(np.int64)
+
+    return [
+        {'produto_id': pid, 'consumo_diario': c, 'desvio_diario': d, 'dias_cobertura': dc, 'sugestao': sg}
+        for pid, c, d, dc, sg in zip(produtos['id'][com_consumo].tolist(), consumo[com_consumo].tolist(), desvio[com_consumo].tolist(),
+                                     cobertura[com_consumo].tolist(), sugestao[com_consumo].tolist())
+    ]
+
+def _marcador_previsao(chave, valor=None):
+    if valor is None:
+        return db.session.query(VersaoDados.versao).filter_by(chave=chave).scalar()
+    stmt = sqlite_insert(VersaoDados).values(chave=chave, versao=valor)
+    db.session.execute(stmt.on_conflict_do_update(index_elements=[VersaoDados.chave], set_={'versao': valor}))
+
+# Mantém previsao_demanda em dia. Os marcadores em versao_dados guardam o último movimento considerado
+# e o dia do último cálculo completo, então qualquer worker (ou o comando da CLI) continua de onde parou.
+# Com em_segundo_plano=True (rotas), um recálculo completo não roda na requisição: é agendado no executor
+# das tarefas e, até ele terminar, as telas usam a tabela já gravada.
+def atualizar_previsoes(completo=False, em_segundo_plano=False):
+    ultimo_movimento = db.session.query(func.coalesce(func.max(Movimento.id), 0)).scalar() # Lido antes do cálculo
+    processado = _marcador_previsao('previsao_ultimo_movimento')
+    hoje = datetime.utcnow().date().toordinal()
+    if completo or processado is None or _marcador_previsao('previsao_dia') != hoje:
+        produto_ids = None
+    else:
+        if ultimo_movimento == processado:
+            return 0
+        produto_ids = [pid for pid, in db.session.query(Movimento.produto_id).filter(
+            Movimento.id > processado, Movimento.id <= ultimo_movimento).distinct()]
+        if len(produto_ids) > MAX_PRODUTOS_INCREMENTAL:
+            produto_ids = None
+    if produto_ids is None and em_segundo_plano:
+        agendar_recalculo_previsoes()
+        return 0
+    previsoes = calcular_previsoes(produto_ids)
+    if produto_ids is None:
+        db.session.query(PrevisaoDemanda).delete(synchronize_session=False)
+        _marcador_previsao('previsao_dia', hoje)
+    else:
+        for i in range(0, len(produto_ids), TAMANHO_BLOCO_IN):
+            db.session.query(PrevisaoDemanda).filter(
+                PrevisaoDemanda.produto_id.in_(produto_ids[i:i + TAMANHO_BLOCO_IN])).delete(synchronize_session=False)
+    if previsoes:
+        db.session.execute(insert(PrevisaoDemanda), previsoes)
+    _marcador_previsao('previsao_ultimo_movimento', ultimo_movimento)
+    db.session.commit()
+    return len(previsoes) if produto_ids is None else len(produto_ids)
+
+lock_recalculo_previsoes = threading.Lock()
+
+# Um recálculo completo por worker de cada vez; se outro worker já o fez, este só aplica o incremental
+def agendar_recalculo_previsoes():
+    if not lock_recalculo_previsoes.acquire(blocking=False):
+        return
+    def executar():
+        try:
+            with app.app_context():
+                atualizar_previsoes()
+        except Exception:
+            app.logger.exception("Falha no recálculo das previsões de demanda")
+        finally:
+            lock_recalculo_previsoes.release()
+    executor_tarefas.submit(executar)
+
+@app.cli.command('atualizar-previsoes')
+@click.option('--completo', is_flag=True, help='Recalcula todo o catálogo, não só os produtos com movimentos novos.')
+def atualizar_previsoes_comando(completo):
+    """Recalcula consumo, dias de cobertura e sugestões de reposição."""
+    inicio = time.perf_counter()
+    produtos = atualizar_previsoes(completo)
+    print(f"{produtos} produto(s) recalculado(s) em {time.perf_counter() - inicio:.2f}s.")
+
+# Sugestões ainda não presentes na lista, das mais urgentes (menor cobertura) para as menos
+def sugestoes_reposicao(limite=SUGESTOES_NA_PAGINA):
+    return db.session.query(
+        Produto.id, Produto.nome, Produto.quantidade, PrevisaoDemanda.consumo_diario,
+        PrevisaoDemanda.dias_cobertura, PrevisaoDemanda.sugestao
+    ).join(Produto, PrevisaoDemanda.produto_id == Produto.id).outerjoin(
+        ItemPedido, ItemPedido.produto_id == PrevisaoDemanda.produto_id
+    ).filter(PrevisaoDemanda.sugestao > 0, ItemPedido.produto_id.is_(None)).order_by(
+        PrevisaoDemanda.dias_cobertura
+    ).limit(limite).all()
+
 # --- ROTAS DA LISTA DE PEDIDOS ---
-# (lista_pedidos_page, adicionar_a_lista, limpar_lista - sem mudanças)
 @app.route('/lista_pedidos')
 @login_required
 def lista_pedidos_page():
-    lista_completa = []
-    for produto_id_str, quantidade_pedida in lista_pedidos.items():
-        produto = Produto.query.get(int(produto_id_str))
-        if produto:
-            lista_completa.append({'id': produto.id, 'nome': produto.nome, 'quantidade_pedida': quantidade_pedida})
-    todos_produtos = Produto.query.order_by(Produto.nome).all()
-    return render_template('lista_pedidos.html', lista_itens=lista_completa, todos_produtos=todos_produtos)
+    # Uma única consulta com JOIN no catálogo (sem um SELECT por item)
+    itens = db.session.query(ItemPedido.produto_id, Produto.nome, ItemPedido.quantidade).join(
+        Produto, ItemPedido.produto_id == Produto.id
+    ).order_by(Produto.nome).all()
+    lista_completa = [{'id': pid, 'nome': nome, 'quantidade_pedida': qtd} for pid, nome, qtd in itens]
+    atualizar_previsoes(em_segundo_plano=True) # Incremental: só os produtos movimentados desde a última visita
+    return render_template('lista_pedidos.html', lista_itens=lista_completa, sugestoes=sugestoes_reposicao(),
+                           prazo_reposicao=PRAZO_REPOSICAO_DIAS, cobertura_alvo=COBERTURA_ALVO_DIAS)
+
+# Upsert atômico: INSERT ... SELECT do produto (só insere se ele existir) ON CONFLICT soma a quantidade.
+# Retorna False se o produto não existe.
+def adicionar_item_pedido(produto_id, quantidade):
+    stmt = sqlite_insert(ItemPedido).from_select(
+        ['produto_id', 'quantidade', 'atualizado_em'],
+        db.select(Produto.id, db.literal(quantidade), db.literal(datetime.utcnow())).where(Produto.id == produto_id)
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ItemPedido.produto_id],
+        set_={'quantidade': ItemPedido.quantidade + stmt.excluded.quantidade, 'atualizado_em': stmt.excluded.atualizado_em}
+    )
+    resultado = db.session.execute(stmt)
+    db.session.commit()
+    return resultado.rowcount > 0
 
 @app.route('/adicionar_a_lista', methods=['POST'])
 @login_required
 def adicionar_a_lista():
     try:
-        produto_id = request.form['produto_id']
+        produto_id = int(request.form['produto_id'])
         quantidade = int(request.form['quantidade'])
         if quantidade <= 0: raise ValueError
-        if Produto.query.get(int(produto_id)):
-            lista_pedidos[produto_id] = lista_pedidos.get(produto_id, 0) + quantidade
+        if adicionar_item_pedido(produto_id, quantidade):
             flash(f"Item adicionado à lista.", 'success')
         else:
             flash("Produto não encontrado.", 'danger')
@@ -379,113 +1868,543 @@ def adicionar_a_lista():
         flash("A quantidade deve ser um número inteiro positivo.", 'danger')
     return redirect(url_for('lista_pedidos_page'))
 
+# Pré-preenche a lista com todas as sugestões; itens já na lista são mantidos como estão
+@app.route('/lista_pedidos/sugestoes', methods=['POST'])
+@login_required
+def adicionar_sugestoes_a_lista():
+    atualizar_previsoes(em_segundo_plano=True)
+    stmt = sqlite_insert(ItemPedido).from_select(
+        ['produto_id', 'quantidade', 'atualizado_em'],
+        db.select(PrevisaoDemanda.produto_id, PrevisaoDemanda.sugestao, db.literal(datetime.utcnow())).where(PrevisaoDemanda.sugestao > 0)
+    ).on_conflict_do_nothing(index_elements=[ItemPedido.produto_id])
+    adicionados = db.session.execute(stmt).rowcount
+    db.session.commit()
+    flash(f"{adicionados} sugestão(ões) de reposição adicionada(s) à lista.", 'success')
+    return redirect(url_for('lista_pedidos_page'))
+
 @app.route('/limpar_lista', methods=['POST'])
 @login_required
 def limpar_lista():
-    global lista_pedidos
-    lista_pedidos = {}
+    ItemPedido.query.delete()
+    db.session.commit()
     flash("Lista de pedidos limpa com sucesso!", 'success')
     return redirect(url_for('lista_pedidos_page'))
 
 
 # --- ROTAS DE RELATÓRIO E EXPORTAÇÃO ---
-# (relatorio_menu, relatorio_entradas, relatorio_saidas, exportar_entradas, exportar_saidas - sem mudanças)
+# Filtro de período compartilhado pelos relatórios e pelas exportações.
+# Lança ValueError se alguma data não estiver no formato AAAA-MM-DD.
+def filtrar_periodo(query, data_inicio_str, data_fim_str, coluna=Movimento.timestamp):
+    if data_inicio_str:
+        data_inicio = datetime.strptime(data_inicio_str, '%Y-%m-%d')
+        query = query.filter(coluna >= data_inicio)
+    if data_fim_str:
+        data_fim = datetime.strptime(data_fim_str, '%Y-%m-%d') + timedelta(days=1)
+        query = query.filter(coluna < data_fim)
+    return query
+
 @app.route('/relatorio')
 @login_required
 def relatorio_menu():
     return render_template('relatorio_menu.html')
 
+# --- RELATÓRIOS AGREGADOS E PAGINADOS ---
+TAMANHO_PAGINA_RELATORIO = 100
+# Agrupamentos por período feitos no próprio SQLite (GROUP BY strftime), sem trazer as linhas para o Python
+FORMATOS_PERIODO = {
+    'dia': '%Y-%m-%d',
+    'semana': '%Y-S%W',
+    'mes': '%Y-%m',
+}
+
+# Totais por período ou por produto: uma linha por grupo, independente de quantos movimentos existem.
+def agregar_movimentos(query, agrupar):
+    if agrupar == 'produto':
+        return query.join(Produto, Movimento.produto_id == Produto.id).with_entities(
+            (func.cast(Movimento.produto_id, db.String) + ' - ' + Produto.nome).label('grupo'),
+            func.sum(Movimento.quantidade).label('total'),
+            func.count(Movimento.id).label('movimentos'),
+        ).group_by(Movimento.produto_id, Produto.nome).order_by(func.sum(Movimento.quantidade).desc()).all()
+    periodo = func.strftime(FORMATOS_PERIODO[agrupar], Movimento.timestamp).label('grupo')
+    return query.with_entities(
+        periodo,
+        func.sum(Movimento.quantidade).label('total'),
+        func.count(Movimento.id).label('movimentos'),
+    ).group_by(periodo).order_by(periodo.desc()).all()
+
+# Linhas brutas com keyset em (timestamp, id) decrescente; o cursor é "<timestamp ISO>_<id>" da última linha.
+def paginar_movimentos(query, cursor=None, limite=TAMANHO_PAGINA_RELATORIO):
+    if cursor:
+        ts_str, _, id_str = cursor.rpartition('_')
+        query = query.filter(db.tuple_(Movimento.timestamp, Movimento.id) < (datetime.fromisoformat(ts_str), int(id_str)))
+    linhas = query.join(Produto, Movimento.produto_id == Produto.id).with_entities(
+        Movimento.id, Movimento.timestamp, Movimento.produto_id, Produto.nome, Movimento.quantidade
+    ).order_by(Movimento.timestamp.desc(), Movimento.id.desc()).limit(limite + 1).all()
+    proximo_cursor = None
+    if len(linhas) > limite:
+        linhas = linhas[:limite]
+        proximo_cursor = f"{linhas[-1].timestamp.isoformat()}_{linhas[-1].id}"
+    return linhas, proximo_cursor
+
+def gerar_relatorio(tipo, tipo_relatorio, rota_exportar):
+    # Aceita os filtros via GET (links de paginação) ou POST (formulário antigo)
+    data_inicio_str = request.values.get('data_inicio')
+    data_fim_str = request.values.get('data_fim')
+    agrupar = request.values.get('agrupar', '')
+    if agrupar not in FORMATOS_PERIODO and agrupar != 'produto':
+        agrupar = ''
+    query = Movimento.query.filter_by(tipo=tipo)
+    try: # Adicionar try-except para datas inválidas
+        query = filtrar_periodo(query, data_inicio_str, data_fim_str)
+    except ValueError:
+        flash("Formato de data inválido. Use AAAA-MM-DD.", "danger")
+
+    grupos, movimentos, proximo_cursor = None, None, None
+    if agrupar:
+        grupos = agregar_movimentos(query, agrupar)
+    else:
+        try:
+            movimentos, proximo_cursor = paginar_movimentos(query, request.values.get('cursor'))
+        except ValueError:
+            movimentos, proximo_cursor = paginar_movimentos(query) # Cursor adulterado: volta ao início
+    return render_template('relatorio_view.html', movimentos=movimentos, grupos=grupos, agrupar=agrupar,
+                           proximo_cursor=proximo_cursor, tipo_relatorio=tipo_relatorio, rota_exportar=rota_exportar,
+                           data_inicio=data_inicio_str, data_fim=data_fim_str)
+
 @app.route('/relatorio/entradas', methods=['GET', 'POST'])
 @login_required
+@get_condicional()
 def relatorio_entradas():
-    query = Movimento.query.filter_by(tipo='entrada')
-    data_inicio_str = request.form.get('data_inicio')
-    data_fim_str = request.form.get('data_fim')
-    if request.method == 'POST':
-        try: # Adicionar try-except para datas inválidas
-            if data_inicio_str:
-                data_inicio = datetime.strptime(data_inicio_str, '%Y-%m-%d')
-                query = query.filter(Movimento.timestamp >= data_inicio)
-            if data_fim_str:
-                data_fim = datetime.strptime(data_fim_str, '%Y-%m-%d') + timedelta(days=1)
-                query = query.filter(Movimento.timestamp < data_fim)
-        except ValueError:
-            flash("Formato de data inválido. Use AAAA-MM-DD.", "danger")
-    movimentos = query.order_by(Movimento.timestamp.desc()).all()
-    return render_template('relatorio_view.html', movimentos=movimentos, tipo_relatorio="Entradas", data_inicio=data_inicio_str, data_fim=data_fim_str)
+    return gerar_relatorio('entrada', "Entradas", 'exportar_entradas')
 
 @app.route('/relatorio/saidas', methods=['GET', 'POST'])
 @login_required
+@get_condicional()
 def relatorio_saidas():
-    query = Movimento.query.filter_by(tipo='saida')
-    data_inicio_str = request.form.get('data_inicio')
-    data_fim_str = request.form.get('data_fim')
-    if request.method == 'POST':
-        try: # Adicionar try-except para datas inválidas
-            if data_inicio_str:
-                data_inicio = datetime.strptime(data_inicio_str, '%Y-%m-%d')
-                query = query.filter(Movimento.timestamp >= data_inicio)
-            if data_fim_str:
-                data_fim = datetime.strptime(data_fim_str, '%Y-%m-%d') + timedelta(days=1)
-                query = query.filter(Movimento.timestamp < data_fim)
-        except ValueError:
-            flash("Formato de data inválido. Use AAAA-MM-DD.", "danger")
-    movimentos = query.order_by(Movimento.timestamp.desc()).all()
-    return render_template('relatorio_view.html', movimentos=movimentos, tipo_relatorio="Saídas", data_inicio=data_inicio_str, data_fim=data_fim_str)
+    return gerar_relatorio('saida', "Saídas", 'exportar_saidas')
+
+
+# --- EXPORTAÇÃO CSV EM STREAMING ---
+LINHAS_POR_LOTE_EXPORTACAO = 1000
+
+# Gera o CSV aos poucos: lê as linhas já com o nome do produto (JOIN, sem
+# uma consulta por movimento) em lotes de LINHAS_POR_LOTE_EXPORTACAO e
+# devolve cada lote como texto, então a memória não cresce com o tamanho da exportação.
+def gerar_csv_movimentos(tipo, data_inicio_str=None, data_fim_str=None):
+    query = db.session.query(
+        Movimento.timestamp, Movimento.produto_id, Produto.nome, Movimento.quantidade
+    ).join(Produto, Movimento.produto_id == Produto.id).filter(Movimento.tipo == tipo)
+    query = filtrar_periodo(query, data_inicio_str, data_fim_str)
+    query = query.order_by(Movimento.timestamp.asc()).execution_options(yield_per=LINHAS_POR_LOTE_EXPORTACAO)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['Data', 'Hora (UTC)', 'Codigo do Produto', 'Nome do Produto', 'Quantidade'])
+    for i, (timestamp, produto_id, nome, quantidade) in enumerate(query, start=1):
+        writer.writerow([timestamp.strftime('%d/%m/%Y'), timestamp.strftime('%H:%M:%S'), produto_id, nome, quantidade])
+        if i % LINHAS_POR_LOTE_EXPORTACAO == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    yield buffer.getvalue()
 
+def exportar_movimentos(tipo, nome_arquivo):
+    data_inicio_str = request.args.get('data_inicio')
+    data_fim_str = request.args.get('data_fim')
+    try:
+        filtrar_periodo(Movimento.query, data_inicio_str, data_fim_str) # Valida as datas antes de começar o stream
+    except ValueError:
+        flash("Formato de data inválido. Use AAAA-MM-DD.", "danger")
+        return redirect(url_for('relatorio_menu'))
+    return Response(
+        stream_with_context(gerar_csv_movimentos(tipo, data_inicio_str, data_fim_str)),
+        mimetype="text/csv",
+        headers={"Content-Disposition": f"attachment;filename={nome_arquivo}"}
+    )
 
 @app.route('/exportar/entradas')
 @login_required
+@get_condicional()
 def exportar_entradas():
-    movimentos = Movimento.query.filter_by(tipo='entrada').order_by(Movimento.timestamp.asc()).all()
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['Data', 'Hora (UTC)', 'Codigo do Produto', 'Nome do Produto', 'Quantidade'])
-    for mov in movimentos:
-        writer.writerow([mov.timestamp.strftime('%d/%m/%Y'), mov.timestamp.strftime('%H:%M:%S'), mov.produto.id, mov.produto.nome, mov.quantidade])
-    output.seek(0)
-    return Response(output, mimetype="text/csv", headers={"Content-Disposition": "attachment;filename=relatorio_entradas.csv"})
+    return exportar_movimentos('entrada', 'relatorio_entradas.csv')
 
 @app.route('/exportar/saidas')
 @login_required
+@get_condicional()
 def exportar_saidas():
-    movimentos = Movimento.query.filter_by(tipo='saida').order_by(Movimento.timestamp.asc()).all()
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['Data', 'Hora (UTC)', 'Codigo do Produto', 'Nome do Produto', 'Quantidade'])
-    for mov in movimentos:
-        writer.writerow([mov.timestamp.strftime('%d/%m/%Y'), mov.timestamp.strftime('%H:%M:%S'), mov.produto.id, mov.produto.nome, mov.quantidade])
-    output.seek(0)
-    return Response(output, mimetype="text/csv", headers={"Content-Disposition": "attachment;filename=relatorio_saidas.csv"})
+    return exportar_movimentos('saida', 'relatorio_saidas.csv')
+
+# --- EXECUÇÃO DAS TAREFAS EM SEGUNDO PLANO ---
+# Cada worker tem um pool pequeno de threads; a tarefa roda no worker que a criou e grava o resultado em
+# disco (instance/tarefas), e a tela acompanha o progresso por um fragmento HTMX consultado a cada segundo.
+# O estado fica na tabela tarefa, então qualquer worker responde o status e entrega o arquivo.
+TAREFAS_SIMULTANEAS = 2
+VALIDADE_ARTEFATO = timedelta(hours=24)
+INTERVALO_PROGRESSO_S = 0.5
+PASTA_TAREFAS = os.path.join(app.instance_path, 'tarefas')
+TIPOS_TAREFA = {
+    'exportar_entradas': ('entrada', None),
+    'exportar_saidas': ('saida', None),
+    'relatorio_entradas': ('entrada', 'agregado'),
+    'relatorio_saidas': ('saida', 'agregado'),
+}
+executor_tarefas = concurrent.futures.ThreadPoolExecutor(max_workers=TAREFAS_SIMULTANEAS, thread_name_prefix='tarefa')
+
+def _atualizar_tarefa(tarefa_id, **valores):
+    # Conexão própria: a sessão da tarefa pode estar no meio de uma leitura em streaming (yield_per)
+    with db.engine.begin() as conn:
+        conn.execute(update(Tarefa).where(Tarefa.id == tarefa_id).values(**valores))
+
+def _escrever_linhas(caminho, compactar, blocos):
+    temporario = caminho + '.parcial'
+    abrir = gzip.open if compactar else open
+    with abrir(temporario, 'wt', newline='', encoding='utf-8') as f:
+        for bloco in blocos:
+            f.write(bloco)
+    os.replace(temporario, caminho) # O arquivo só aparece completo
+
+def _csv_agregado(tipo, parametros):
+    query = filtrar_periodo(Movimento.query.filter_by(tipo=tipo), parametros.get('data_inicio'), parametros.get('data_fim'))
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['Produto' if parametros['agrupar'] == 'produto' else 'Periodo', 'Quantidade Total', 'Movimentos'])
+    writer.writerows((grupo, total, movimentos) for grupo, total, movimentos in agregar_movimentos(query, parametros['agrupar']))
+    yield buffer.getvalue()
+
+def executar_tarefa(tarefa_id):
+    with app.app_context():
+        # Só um worker assume a tarefa: UPDATE condicional no status
+        assumida = db.session.execute(update(Tarefa).where(
+            Tarefa.id == tarefa_id, Tarefa.status == 'pendente'
+        ).values(status='executando', processo=os.getpid()).execution_options(synchronize_session=False)).rowcount
+        db.session.commit()
+        if not assumida:
+            return
+        tarefa = db.session.get(Tarefa, tarefa_id)
+        parametros = json.loads(tarefa.parametros)
+        tipo_movimento, formato = TIPOS_TAREFA[tarefa.tipo]
+        caminho = os.path.join(PASTA_TAREFAS, f"{tarefa.id}.csv" + ('.gz' if parametros.get('gzip') else ''))
+        try:
+            os.makedirs(PASTA_TAREFAS, exist_ok=True)
+            if formato == 'agregado':
+                blocos = _csv_agregado(tipo_movimento, parametros)
+            else:
+                total = filtrar_periodo(Movimento.query.filter_by(tipo=tipo_movimento),
+                                        parametros.get('data_inicio'), parametros.get('data_fim')).count()
+                _atualizar_tarefa(tarefa_id, total=total)
+                blocos = _com_progresso(tarefa_id, gerar_csv_movimentos(
+                    tipo_movimento, parametros.get('data_inicio'), parametros.get('data_fim')))
+            _escrever_linhas(caminho, parametros.get('gzip'), blocos)
+            _atualizar_tarefa(tarefa_id, status='concluida', arquivo=caminho, concluido_em=datetime.utcnow())
+        except Exception as e:
+            app.logger.exception("Falha na tarefa %s", tarefa_id)
+            _atualizar_tarefa(tarefa_id, status='erro', erro=str(e)[:255], concluido_em=datetime.utcnow())
+        finally:
+            db.session.remove()
+
+# gerar_csv_movimentos entrega blocos de LINHAS_POR_LOTE_EXPORTACAO linhas; o progresso é contado por bloco
+def _com_progresso(tarefa_id, blocos):
+    progresso, ultimo_registro = 0, time.monotonic()
+    for i, bloco in enumerate(blocos):
+        progresso = i * LINHAS_POR_LOTE_EXPORTACAO
+        if time.monotonic() - ultimo_registro >= INTERVALO_PROGRESSO_S:
+            _atualizar_tarefa(tarefa_id, progresso=progresso)
+            ultimo_registro = time.monotonic()
+        yield bloco
+
+def _processo_vivo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+# Tarefa cujo worker morreu (restart do gunicorn, OOM) volta para a fila e roda neste worker
+def _retomar_se_abandonada(tarefa):
+    if tarefa.status in ('pendente', 'executando') and tarefa.processo and not _processo_vivo(tarefa.processo):
+        retomada = db.session.execute(update(Tarefa).where(
+            Tarefa.id == tarefa.id, Tarefa.processo == tarefa.processo
+        ).values(status='pendente', processo=os.getpid(), progresso=0).execution_options(synchronize_session=False)).rowcount
+        db.session.commit()
+        if retomada:
+            executor_tarefas.submit(executar_tarefa, tarefa.id)
+        db.session.refresh(tarefa)
+
+def limpar_tarefas_expiradas():
+    limite = datetime.utcnow() - VALIDADE_ARTEFATO
+    expiradas = Tarefa.query.filter(Tarefa.concluido_em < limite).all()
+    for tarefa in expiradas:
+        if tarefa.arquivo and os.path.exists(tarefa.arquivo):
+            os.remove(tarefa.arquivo)
+        db.session.delete(tarefa)
+    db.session.commit()
+    return len(expiradas)
+
+def criar_tarefa(tipo, parametros, user_id):
+    parametros = {chave: valor for chave, valor in parametros.items() if valor}
+    versao = versao_estoque()
+    chave = hashlib.sha1(json.dumps([tipo, parametros, versao], sort_keys=True).encode()).hexdigest()
+    # Mesmo pedido sobre os mesmos dados: devolve a tarefa em andamento ou o arquivo ainda válido
+    existente = Tarefa.query.filter(
+        Tarefa.chave == chave, Tarefa.status != 'erro',
+        (Tarefa.concluido_em.is_(None)) | (Tarefa.concluido_em >= datetime.utcnow() - VALIDADE_ARTEFATO)
+    ).order_by(Tarefa.id.desc()).first()
+    if existente and (existente.status != 'concluida' or os.path.exists(existente.arquivo or '')):
+        _retomar_se_abandonada(existente)
+        return existente
+    tarefa = Tarefa(chave=chave, tipo=tipo, parametros=json.dumps(parametros), processo=os.getpid(), user_id=user_id)
+    db.session.add(tarefa)
+    db.session.commit()
+    executor_tarefas.submit(executar_tarefa, tarefa.id)
+    return tarefa
+
+@app.route('/tarefas', methods=['POST'])
+@login_required
+def nova_tarefa():
+    tipo = request.form.get('tipo_tarefa', '')
+    agrupar = request.form.get('agrupar', '')
+    if tipo not in TIPOS_TAREFA or (TIPOS_TAREFA[tipo][1] == 'agregado' and agrupar not in FORMATOS_PERIODO and agrupar != 'produto'):
+        abort(400)
+    parametros = {
+        'data_inicio': request.form.get('data_inicio', '').strip(),
+        'data_fim': request.form.get('data_fim', '').strip(),
+        'agrupar': agrupar if TIPOS_TAREFA[tipo][1] == 'agregado' else '',
+        'gzip': request.form.get('gzip') == '1',
+    }
+    try:
+        filtrar_periodo(Movimento.query, parametros['data_inicio'], parametros['data_fim']) # Valida as datas antes de enfileirar
+    except ValueError:
+        abort(400)
+    limpar_tarefas_expiradas()
+    tarefa = criar_tarefa(tipo, parametros, current_user.id)
+    return render_template('_status_tarefa.html', tarefa=tarefa)
+
+@app.route('/tarefas/<int:tarefa_id>')
+@login_required
+def status_tarefa(tarefa_id):
+    tarefa = db.session.get(Tarefa, tarefa_id) or abort(404)
+    _retomar_se_abandonada(tarefa)
+    return render_template('_status_tarefa.html', tarefa=tarefa)
+
+@app.route('/tarefas/<int:tarefa_id>/baixar')
+@login_required
+def baixar_tarefa(tarefa_id):
+    tarefa = db.session.get(Tarefa, tarefa_id)
+    if not tarefa or tarefa.status != 'concluida' or not os.path.exists(tarefa.arquivo or ''):
+        abort(404)
+    nome = f"{tarefa.tipo}_{tarefa.criado_em:%Y%m%d_%H%M%S}" + os.path.basename(tarefa.arquivo)[len(str(tarefa.id)):]
+    return send_file(tarefa.arquivo, as_attachment=True, download_name=nome,
+                     mimetype='application/gzip' if tarefa.arquivo.endswith('.gz') else 'text/csv')
+
+@app.cli.command('limpar-tarefas')
+def limpar_tarefas_comando():
+    """Remove tarefas e arquivos gerados que já expiraram."""
+    print(f"{limpar_tarefas_expiradas()} tarefa(s) expirada(s) removida(s).")
+
+# --- HISTÓRICO DE EDIÇÕES: FILTROS, PAGINAÇÃO E ARQUIVAMENTO ---
+TAMANHO_PAGINA_HISTORICO = 100
+LINHAS_POR_BLOCO_ARQUIVO = 5000
+CAMPOS_HISTORICO = ['nome', 'exclusao']
+
+# Filtros vindos da query string; valores inválidos são ignorados, datas inválidas levantam ValueError
+def filtros_historico(args):
+    return {
+        'produto_id': args.get('produto_id', type=int),
+        'user_id': args.get('user_id', type=int),
+        'campo': args.get('campo') if args.get('campo') in CAMPOS_HISTORICO else None,
+        'data_inicio': args.get('data_inicio') or None,
+        'data_fim': args.get('data_fim') or None,
+    }
+
+def filtrar_historico(query, filtros, modelo=EditHistory):
+    if filtros['produto_id'] is not None:
+        query = query.filter(modelo.produto_id == filtros['produto_id'])
+    if filtros['user_id'] is not None:
+        query = query.filter(modelo.user_id == filtros['user_id'])
+    if filtros['campo']:
+        query = query.filter(modelo.campo_alterado == filtros['campo'])
+    return filtrar_periodo(query, filtros['data_inicio'], filtros['data_fim'], coluna=modelo.timestamp)
+
+# Mesmo cursor "timestamp_id" dos relatórios: ordem estável mesmo com timestamps repetidos
+def paginar_historico(filtros, cursor=None, limite=TAMANHO_PAGINA_HISTORICO):
+    query = filtrar_historico(db.session.query(
+        EditHistory.id, EditHistory.timestamp, EditHistory.produto_id, EditHistory.nome_produto_na_epoca,
+        EditHistory.campo_alterado, EditHistory.valor_antigo, EditHistory.valor_novo, Usuario.username
+    ).outerjoin(Usuario, EditHistory.user_id == Usuario.id), filtros)
+    if cursor:
+        ts_str, _, id_str = cursor.rpartition('_')
+        query = query.filter(db.tuple_(EditHistory.timestamp, EditHistory.id) < (datetime.fromisoformat(ts_str), int(id_str)))
+    linhas = query.order_by(EditHistory.timestamp.desc(), EditHistory.id.desc()).limit(limite + 1).all()
+    proximo_cursor = None
+    if len(linhas) > limite:
+        linhas = linhas[:limite]
+        proximo_cursor = f"{linhas[-1].timestamp.isoformat()}_{linhas[-1].id}"
+    return linhas, proximo_cursor
+
+def gerar_csv_historico(filtros, modelo=EditHistory):
+    query = filtrar_historico(db.session.query(
+        modelo.timestamp, Usuario.username, modelo.produto_id, modelo.nome_produto_na_epoca,
+        modelo.campo_alterado, modelo.valor_antigo, modelo.valor_novo
+    ).outerjoin(Usuario, modelo.user_id == Usuario.id), filtros, modelo)
+    query = query.order_by(modelo.timestamp.asc(), modelo.id.asc()).execution_options(yield_per=LINHAS_POR_LOTE_EXPORTACAO)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['Data', 'Hora (UTC)', 'Usuario', 'Codigo do Produto', 'Nome do Produto', 'Campo Alterado', 'Valor Antigo', 'Valor Novo'])
+    for i, (timestamp, username, produto_id, nome, campo, antigo, novo) in enumerate(query, start=1):
+        writer.writerow([timestamp.strftime('%d/%m/%Y'), timestamp.strftime('%H:%M:%S'), username or 'Usuário Deletado',
+                         produto_id, nome, campo, antigo, novo])
+        if i % LINHAS_POR_LOTE_EXPORTACAO == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    yield buffer.getvalue()
+
+# Move as linhas anteriores a `corte` para edit_history_arquivo (ou para o CSV de `escritor_csv`),
+# em blocos por id com um commit cada, para não segurar o lock de escrita do SQLite.
+def arquivar_historico(corte, escritor_csv=None):
+    colunas = ['id', 'produto_id', 'user_id', 'campo_alterado', 'nome_produto_na_epoca', 'valor_antigo', 'valor_novo', 'timestamp']
+    arquivadas = 0
+    while True:
+        linhas = db.session.query(*[getattr(EditHistory, c) for c in colunas]).filter(
+            EditHistory.timestamp < corte
+        ).order_by(EditHistory.id).limit(LINHAS_POR_BLOCO_ARQUIVO).all()
+        if not linhas:
+            break
+        if escritor_csv is not None:
+            escritor_csv.writerows([[l.timestamp.isoformat() if c == 'timestamp' else getattr(l, c) for c in colunas] for l in linhas])
+        else:
+            db.session.execute(insert(EditHistoryArquivo), [dict(zip(colunas, l)) for l in linhas])
+        db.session.execute(db.delete(EditHistory).where(EditHistory.id.in_([l.id for l in linhas])))
+        db.session.commit()
+        arquivadas += len(linhas)
+    return arquivadas
+
+@app.cli.command('arquivar-historico')
+@click.option('--dias', default=365, show_default=True, help='Arquiva o histórico mais antigo que esse número de dias.')
+@click.option('--csv', 'arquivo_csv', type=click.Path(dir_okay=False), help='Grava as linhas neste CSV (acrescenta) em vez da tabela de arquivo.')
+def arquivar_historico_comando(dias, arquivo_csv):
+    """Move o histórico de edições antigo para fora da tabela principal."""
+    corte = datetime.utcnow() - timedelta(days=dias)
+    if arquivo_csv:
+        novo = not os.path.exists(arquivo_csv)
+        with open(arquivo_csv, 'a', newline='', encoding='utf-8') as f:
+            escritor = csv.writer(f)
+            if novo:
+                escritor.writerow(['id', 'produto_id', 'user_id', 'campo_alterado', 'nome_produto_na_epoca', 'valor_antigo', 'valor_novo', 'timestamp'])
+            arquivadas = arquivar_historico(corte, escritor)
+    else:
+        arquivadas = arquivar_historico(corte)
+    print(f"{arquivadas} registro(s) anteriores a {corte:%Y-%m-%d} arquivado(s) em {arquivo_csv or 'edit_history_arquivo'}.")
 
-# --- NOVA ROTA PARA VISUALIZAR HISTÓRICO ---
 @app.route('/historico')
 @login_required
 def historico_page():
-    historico_list = EditHistory.query.options(
-        joinedload(EditHistory.usuario) # Carrega dados do usuário junto
-    ).order_by(EditHistory.timestamp.desc()).all()
-    
-    return render_template('historico.html', historico=historico_list)
+    filtros = filtros_historico(request.args)
+    try:
+        historico_list, proximo_cursor = paginar_historico(filtros, request.args.get('cursor'))
+    except ValueError:
+        flash("Filtro ou página inválidos. Use datas no formato AAAA-MM-DD.", "danger")
+        filtros['data_inicio'] = filtros['data_fim'] = None
+        historico_list, proximo_cursor = paginar_historico(filtros)
+    usuarios = db.session.query(Usuario.id, Usuario.username).order_by(Usuario.username).all()
+    return render_template('historico.html', historico=historico_list, proximo_cursor=proximo_cursor,
+                           filtros=filtros, usuarios=usuarios, campos=CAMPOS_HISTORICO)
+
+@app.route('/historico/exportar')
+@login_required
+def exportar_historico():
+    filtros = filtros_historico(request.args)
+    try:
+        filtrar_periodo(EditHistory.query, filtros['data_inicio'], filtros['data_fim']) # Valida as datas antes do stream
+    except ValueError:
+        flash("Formato de data inválido. Use AAAA-MM-DD.", "danger")
+        return redirect(url_for('historico_page'))
+    arquivado = request.args.get('arquivo') == '1'
+    return Response(
+        stream_with_context(gerar_csv_historico(filtros, EditHistoryArquivo if arquivado else EditHistory)),
+        mimetype="text/csv",
+        headers={"Content-Disposition": f"attachment;filename={'historico_arquivado' if arquivado else 'historico_edicoes'}.csv"}
+    )
+
+# --- FÁBRICA DA APLICAÇÃO E INICIALIZAÇÃO DO BANCO ---
+# Aplica o perfil, as variáveis de ambiente e as extensões. Não abre conexão com o banco: com
+# preload_app (gunicorn.conf.py) o master importa e configura tudo uma vez e os workers só fazem fork.
+def create_app(perfil=None):
+    perfil = perfil or os.environ.get('STOCKIFY_PERFIL', 'desenvolvimento')
+    if perfil not in PERFIS:
+        raise RuntimeError(f"Perfil desconhecido: {perfil} (use {', '.join(PERFIS)})")
+    if 'sqlalchemy' in app.extensions:
+        # A aplicação é única no processo e já foi configurada na importação do módulo: outro perfil
+        # só vale escolhendo-o em STOCKIFY_PERFIL antes de importar app
+        if perfil != app.config['PERFIL']:
+            raise RuntimeError(f"Aplicação já configurada com o perfil {app.config['PERFIL']}; "
+                               f"defina STOCKIFY_PERFIL={perfil} antes de importar app")
+        return app
+    app.config.from_mapping(PERFIS[perfil], PERFIL=perfil)
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('STOCKIFY_DATABASE_URI', 'sqlite:///' + os.path.join(BASE_DIR, 'estoque.db'))
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SECRET_KEY'] = os.environ.get('STOCKIFY_SECRET_KEY', app.config['SECRET_KEY'])
+    if not app.config['SECRET_KEY']:
+        raise RuntimeError("Defina STOCKIFY_SECRET_KEY para o perfil de produção.")
+    # Instrumentação por requisição (/metrics). Desligada, nenhum hook é registrado.
+    app.config['METRICAS_ATIVAS'] = os.environ.get('STOCKIFY_METRICAS', '1') == '1'
+    app.config['LIMITE_REQUISICAO_LENTA_MS'] = float(os.environ.get('STOCKIFY_REQUISICAO_LENTA_MS', '0')) # 0 = sem log
+    if ':memory:' in app.config['SQLALCHEMY_DATABASE_URI'] or app.config['SQLALCHEMY_DATABASE_URI'] == 'sqlite://':
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {} # Banco em memória usa um pool de conexão única
+
+    db.init_app(app)
+    login_manager.init_app(app)
+    if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        with app.app_context():
+            configurar_sqlite(db.engine, app.config['SQLITE_PRAGMAS'])
+    if app.config['METRICAS_ATIVAS']:
+        configurar_metricas(app)
+    return app
+
+# Esquema, migrações e usuário admin inicial: fora do caminho das requisições, uma vez por deploy.
+# senha_padrao=False ignora a SENHA_ADMIN_PADRAO do perfil (admin só com senha informada).
+def inicializar_banco(senha_admin=None, senha_padrao=True):
+    db.create_all()
+    aplicadas = aplicar_migracoes()
+    senha_admin = senha_admin or (app.config['SENHA_ADMIN_PADRAO'] if senha_padrao else None)
+    admin_criado = False
+    if senha_admin and not Usuario.query.filter_by(username='admin').first():
+        admin_user = Usuario(username='admin')
+        admin_user.set_password(senha_admin)
+        db.session.add(admin_user)
+        db.session.commit()
+        admin_criado = True
+    return aplicadas, admin_criado
+
+@app.cli.command('inicializar')
+@click.option('--senha-admin', envvar='STOCKIFY_ADMIN_SENHA', help='Senha do usuário admin criado se ele ainda não existir.')
+def inicializar_comando(senha_admin):
+    """Cria as tabelas, aplica as migrações, enxuga o log de alterações e cria o admin inicial (rode antes de subir o gunicorn)."""
+    # Sem STOCKIFY_PERFIL o comando cai no perfil de desenvolvimento mesmo contra o banco de produção:
+    # o admin/123 de desenvolvimento só é criado se esse perfil foi escolhido explicitamente
+    perfil_explicito = os.environ.get('STOCKIFY_PERFIL') == app.config['PERFIL']
+    aplicadas, admin_criado = inicializar_banco(senha_admin, senha_padrao=perfil_explicito)
+    for versao, descricao in aplicadas:
+        print(f"Migração {versao} aplicada: {descricao}")
+    print(f"{limpar_alteracoes()} alteração(ões) antiga(s) removida(s) do log.")
+    if admin_criado:
+        print("Usuário 'admin' criado.")
+    elif not Usuario.query.filter_by(username='admin').first():
+        print("Usuário 'admin' não criado: informe --senha-admin ou STOCKIFY_ADMIN_SENHA"
+              " (ou STOCKIFY_PERFIL=desenvolvimento para a senha padrão de desenvolvimento).")
+    print(f"Banco pronto ({app.config['PERFIL']}).")
+    if not perfil_explicito:
+        print("Aviso: STOCKIFY_PERFIL não definido; para o deploy use STOCKIFY_PERFIL=producao flask --app app inicializar.")
+
+# gunicorn app:app, flask CLI e python app.py recebem a aplicação já configurada
+create_app()
 
-# --- INICIALIZAÇÃO DO APP ---
 if __name__ == '__main__':
     with app.app_context():
-        # Configurar SQLite para suportar Foreign Keys (importante para cascade)
-        if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
-            from sqlalchemy import event
-            from sqlalchemy.engine import Engine
-            @event.listens_for(Engine, "connect")
-            def set_sqlite_pragma(dbapi_connection, connection_record):
-                cursor = dbapi_connection.cursor()
-                cursor.execute("PRAGMA foreign_keys=ON")
-                cursor.close()
-
-        db.create_all() # Cria tabelas, incluindo EditHistory
-        if not Usuario.query.filter_by(username='admin').first():
-            admin_user = Usuario(username='admin')
-            admin_user.set_password('123')
-            db.session.add(admin_user)
-            db.session.commit()
+        _, admin_criado = inicializar_banco()
+        if admin_criado:
             print("\n!!! ATENÇÃO: Usuário 'admin' criado! !!!\n")
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=app.config['DEBUG'])
\ No newline at end of file
@@ -0,0 +1,402 @@
+# ----------------------------------------------------
+# BENCHMARK DO STOCKIFY - DADOS SINTÉTICOS + ROTAS REAIS
+# ARQUIVO: benchmark.py
+#
+# Uso:
+#   python benchmark.py gerar --escala media
+#   python benchmark.py executar --escala media --modo ambos
+#   python benchmark.py comparar benchmarks/resultados/antes.json benchmarks/resultados/depois.json
+# ----------------------------------------------------
+import argparse
+import http.cookiejar
+import json
+import os
+import resource
+import shutil
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import numpy as np
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+DIR_DADOS = os.path.join(BASE_DIR, 'benchmarks', 'dados')
+DIR_RESULTADOS = os.path.join(BASE_DIR, 'benchmarks', 'resultados')
+
+ESCALAS = {
+    'minima': {'produtos': 100, 'movimentos': 10_000, 'historico': 1_000},
+    'pequena': {'produtos': 1_000, 'movimentos': 100_000, 'historico': 10_000},
+    'media': {'produtos': 10_000, 'movimentos': 1_000_000, 'historico': 100_000},
+    'grande': {'produtos': 100_000, 'movimentos': 10_000_000, 'historico': 1_000_000},
+}
+DIAS_DE_HISTORIA = 365
+LINHAS_POR_LOTE = 200_000
+USUARIO, SENHA = 'admin', '123'
+
+PALAVRAS = ['parafuso', 'porca', 'arruela', 'bucha', 'broca', 'martelo', 'chave', 'serrote', 'alicate', 'fita',
+            'cabo', 'tubo', 'luva', 'cola', 'tinta', 'lixa', 'prego', 'rebite', 'mola', 'disco']
+MEDIDAS = ['M4', 'M6', 'M8', 'M10', 'inox', 'zincado', '3/8', '1/2', 'preto', 'branco', 'grande', 'pequeno']
+
+
+def caminho_banco(escala):
+    return os.path.join(DIR_DADOS, f'estoque_{escala}.db')
+
+
+def importar_app(banco):
+    # O app lê a URI do banco no import; por isso a variável precisa existir antes
+    os.environ['STOCKIFY_DATABASE_URI'] = 'sqlite:///' + banco
+    sys.path.insert(0, BASE_DIR)
+    import app as modulo_app
+    return modulo_app
+
+
+# --- GERAÇÃO DO DATASET ---
+def _timestamps(rng, quantidade, inicio, fim):
+    # Datas ordenadas (como num ledger real) no formato gravado pelo SQLAlchemy no SQLite
+    inicio_us = np.datetime64(inicio, 'us').astype(np.int64)
+    fim_us = np.datetime64(fim, 'us').astype(np.int64)
+    valores = np.sort(rng.integers(inicio_us, fim_us, size=quantidade))
+    return np.char.replace(np.datetime_as_string(valores.astype('datetime64[us]'), unit='us'), 'T', ' ')
+
+
+def gerar(escala, semente=42):
+    tamanhos = ESCALAS[escala]
+    os.makedirs(DIR_DADOS, exist_ok=True)
+    banco = caminho_banco(escala)
+    for sufixo in ('', '-wal', '-shm'):
+        if os.path.exists(banco + sufixo):
+            os.remove(banco + sufixo)
+
+    # Esquema, índices e usuário vêm do próprio app, para o benchmark medir o esquema real
+    modulo_app = importar_app(banco)
+    with modulo_app.app.app_context():
+        modulo_app.db.create_all()
+        modulo_app.aplicar_migracoes()
+        admin = modulo_app.Usuario(username=USUARIO)
+        admin.set_password(SENHA)
+        modulo_app.db.session.add(admin)
+        modulo_app.db.session.commit()
+        modulo_app.db.engine.dispose()
+
+    rng = np.random.default_rng(semente)
+    fim = datetime.utcnow()
+    inicio = fim - timedelta(days=DIAS_DE_HISTORIA)
+    n_produtos = tamanhos['produtos']
+    inicio_geracao = time.perf_counter()
+
+    conn = sqlite3.connect(banco)
+    conn.execute("PRAGMA synchronous=OFF") # Só para a carga; o app usa as próprias configurações
+    nomes = [f"{PALAVRAS[i % len(PALAVRAS)]} {MEDIDAS[(i // len(PALAVRAS)) % len(MEDIDAS)]} {i}"
+             for i in range(1, n_produtos + 1)]
+
+    # Movimentos em lotes, acumulando o saldo de cada produto para manter estoque = ledger
+    saldo = np.zeros(n_produtos + 1, dtype=np.int64)
+    total = tamanhos['movimentos']
+    limites = np.linspace(0, 1, max(1, total // LINHAS_POR_LOTE) + 1)
+    gerados = 0
+    for i in range(len(limites) - 1):
+        quantidade = (total - gerados) if i == len(limites) - 2 else total // (len(limites) - 1)
+        lote_inicio = inicio + (fim - inicio) * limites[i]
+        lote_fim = inicio + (fim - inicio) * limites[i + 1]
+        produto_ids = rng.integers(1, n_produtos + 1, size=quantidade)
+        entradas = rng.random(quantidade) < 0.55
+        quantidades = rng.integers(1, 20, size=quantidade)
+        np.add.at(saldo, produto_ids, np.where(entradas, quantidades, -quantidades))
+        tipos = np.where(entradas, 'entrada', 'saida')
+        conn.executemany(
+            "INSERT INTO movimento (produto_id, tipo, quantidade, timestamp) VALUES (?, ?, ?, ?)",
+            zip(produto_ids.tolist(), tipos.tolist(), quantidades.tolist(),
+                _timestamps(rng, quantidade, lote_inicio, lote_fim).tolist())
+        )
+        gerados += quantidade
+
+    # Produtos que terminariam negativos ganham uma entrada inicial, para o estoque bater com o ledger
+    negativos = np.nonzero(saldo < 0)[0]
+    conn.executemany(
+        "INSERT INTO movimento (produto_id, tipo, quantidade, timestamp) VALUES (?, 'entrada', ?, ?)",
+        ((int(pid), int(-saldo[pid]), inicio.strftime('%Y-%m-%d %H:%M:%S.%f')) for pid in negativos)
+    )
+    saldo[negativos] = 0
+    conn.executemany(
+        "INSERT INTO produto (id, nome, quantidade) VALUES (?, ?, ?)",
+        ((i, nomes[i - 1], int(saldo[i])) for i in range(1, n_produtos + 1))
+    )
+
+    n_historico = tamanhos['historico']
+    produto_ids = rng.integers(1, n_produtos + 1, size=n_historico).tolist()
+    conn.executemany(
+        "INSERT INTO edit_history (produto_id, user_id, campo_alterado, nome_produto_na_epoca, valor_antigo, valor_novo, timestamp)"
+        " VALUES (?, 1, 'nome', ?, ?, ?, ?)",
+        ((pid, nomes[pid - 1], nomes[pid - 1], nomes[pid - 1] + ' (editado)', ts)
+         for pid, ts in zip(produto_ids, _timestamps(rng, n_historico, inicio, fim).tolist()))
+    )
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+    print(f"Dataset '{escala}' gerado em {time.perf_counter() - inicio_geracao:.1f}s: {banco}")
+    return banco
+
+
+# --- ROTAS MEDIDAS ---
+# (nome, método, caminho, função que gera o corpo do POST ou None, repetições relativas)
+def rotas_benchmark(n_produtos):
+    data_inicio = (datetime.utcnow() - timedelta(days=30)).strftime('%Y-%m-%d')
+    return [
+        ('inventario', 'GET', '/inventario', None, 1.0),
+        ('inventario_busca', 'GET', '/inventario?q=parafuso', None, 1.0),
+        ('dashboard', 'GET', '/dashboard', None, 1.0),
+        ('movimentar', 'POST', '/movimentar',
+         lambda i: {'codigo': str(i % n_produtos + 1), 'tipo_movimento': 'entrada', 'quantidade': '1'}, 1.0),
+        ('relatorio_entradas', 'GET', '/relatorio/entradas', None, 1.0),
+        ('relatorio_saidas_mes', 'GET', '/relatorio/saidas?agrupar=mes', None, 0.2),
+        ('exportar_entradas_30d', 'GET', f'/exportar/entradas?data_inicio={data_inicio}', None, 0.1),
+        ('exportar_saidas_30d', 'GET', f'/exportar/saidas?data_inicio={data_inicio}', None, 0.1),
+        ('historico', 'GET', '/historico', None, 0.2),
+    ]
+
+
+def resumir(latencias, duracao_total):
+    ordenadas = sorted(latencias)
+    p99 = ordenadas[min(len(ordenadas) - 1, int(round(0.99 * (len(ordenadas) - 1))))]
+    return {
+        'requisicoes': len(latencias),
+        'p50_ms': round(statistics.median(ordenadas) * 1000, 3),
+        'p99_ms': round(p99 * 1000, 3),
+        'media_ms': round(statistics.fmean(ordenadas) * 1000, 3),
+        'vazao_rps': round(len(latencias) / duracao_total, 2) if duracao_total > 0 else None,
+    }
+
+
+def _filtrar(rotas, nomes):
+    return [r for r in rotas if not nomes or r[0] in nomes]
+
+
+# --- MODO 1: FLASK TEST CLIENT (NO MESMO PROCESSO) ---
+def executar_cliente(banco, repeticoes, nomes_rotas):
+    modulo_app = importar_app(banco)
+    with modulo_app.app.app_context():
+        n_produtos = modulo_app.Produto.query.count()
+    cliente = modulo_app.app.test_client()
+    cliente.post('/login', data={'username': USUARIO, 'password': SENHA})
+    resultados = {}
+    for nome, metodo, caminho, corpo, peso in _filtrar(rotas_benchmark(n_produtos), nomes_rotas):
+        n = max(1, int(repeticoes * peso))
+        latencias = []
+        inicio_rota = time.perf_counter()
+        for i in range(n):
+            inicio = time.perf_counter()
+            if metodo == 'POST':
+                resposta = cliente.post(caminho, data=corpo(i), headers={'HX-Request': 'true'})
+            else:
+                resposta = cliente.get(caminho)
+            resposta.get_data() # Consome respostas em streaming (exportações)
+            latencias.append(time.perf_counter() - inicio)
+            if resposta.status_code >= 500:
+                raise RuntimeError(f"{nome}: HTTP {resposta.status_code}")
+        resultados[nome] = resumir(latencias, time.perf_counter() - inicio_rota)
+        print(f"  [cliente] {nome}: {resultados[nome]}")
+    # ru_maxrss é em KB no Linux
+    return {'rotas': resultados, 'rss_pico_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+
+
+# --- MODO 2: GUNICORN LOCAL (HTTP REAL, VÁRIOS WORKERS) ---
+def _porta_livre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _rss_pico_workers_mb(pid_mestre):
+    # VmHWM = pico de memória residente de cada processo (Linux)
+    pids = [pid_mestre]
+    try:
+        with open(f'/proc/{pid_mestre}/task/{pid_mestre}/children') as f:
+            pids += [int(p) for p in f.read().split()]
+    except OSError:
+        pass
+    picos = []
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for linha in f:
+                    if linha.startswith('VmHWM:'):
+                        picos.append(int(linha.split()[1]) / 1024)
+        except OSError:
+            continue
+    return round(max(picos), 1) if picos else None
+
+
+def _abrir_sessao(base_url):
+    cookies = http.cookiejar.CookieJar()
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(cookies))
+    dados = urllib.parse.urlencode({'username': USUARIO, 'password': SENHA}).encode()
+    opener.open(base_url + '/login', data=dados).read()
+    return opener
+
+
+def executar_gunicorn(banco, repeticoes, nomes_rotas, workers, concorrencia):
+    porta = _porta_livre()
+    base_url = f'http://127.0.0.1:{porta}'
+    ambiente = dict(os.environ, STOCKIFY_DATABASE_URI='sqlite:///' + banco, STOCKIFY_SECRET_KEY='benchmark')
+    processo = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-w', str(workers), '-b', f'127.0.0.1:{porta}', '--timeout', '300', 'app:app'],
+        cwd=BASE_DIR, env=ambiente, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        for _ in range(100): # Espera o gunicorn aceitar conexões
+            try:
+                urllib.request.urlopen(base_url + '/login', timeout=1).read()
+                break
+            except OSError:
+                time.sleep(0.2)
+        else:
+            raise RuntimeError("gunicorn não subiu")
+
+        conn = sqlite3.connect(banco)
+        n_produtos = conn.execute("SELECT count(*) FROM produto").fetchone()[0]
+        conn.close()
+        sessoes = [_abrir_sessao(base_url) for _ in range(concorrencia)]
+
+        def requisitar(args):
+            i, metodo, caminho, corpo = args
+            opener = sessoes[i % concorrencia]
+            dados = urllib.parse.urlencode(corpo(i)).encode() if metodo == 'POST' else None
+            # Como no modo cliente: com HX-Request o POST devolve só o fragmento, sem o redirect para /inventario
+            cabecalhos = {'HX-Request': 'true'} if metodo == 'POST' else {}
+            inicio = time.perf_counter()
+            try:
+                with opener.open(urllib.request.Request(base_url + caminho, data=dados, headers=cabecalhos), timeout=300) as resposta:
+                    while resposta.read(65536):
+                        pass
+            except urllib.error.HTTPError as e:
+                if e.code >= 500:
+                    raise
+            return time.perf_counter() - inicio
+
+        resultados = {}
+        with ThreadPoolExecutor(concorrencia) as pool:
+            for nome, metodo, caminho, corpo, peso in _filtrar(rotas_benchmark(n_produtos), nomes_rotas):
+                n = max(1, int(repeticoes * peso))
+                inicio_rota = time.perf_counter()
+                latencias = list(pool.map(requisitar, [(i, metodo, caminho, corpo) for i in range(n)]))
+                resultados[nome] = resumir(latencias, time.perf_counter() - inicio_rota)
+                print(f"  [gunicorn] {nome}: {resultados[nome]}")
+        return {'rotas': resultados, 'rss_pico_mb': _rss_pico_workers_mb(processo.pid),
+                'workers': workers, 'concorrencia': concorrencia}
+    finally:
+        processo.terminate()
+        processo.wait(timeout=30)
+
+
+def _versao_codigo():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# As rotas medidas escrevem no banco (movimentar, caches, previsões): cada modo roda numa cópia do
+# dataset gerado, para que execuções repetidas e os dois modos meçam exatamente os mesmos dados
+def _copia_de_trabalho(banco, pasta):
+    conn = sqlite3.connect(banco)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)") # Garante que o arquivo principal está completo
+    conn.close()
+    copia = os.path.join(pasta, os.path.basename(banco))
+    shutil.copyfile(banco, copia)
+    return copia
+
+
+def executar(args):
+    banco = caminho_banco(args.escala)
+    if not os.path.exists(banco):
+        gerar(args.escala)
+    resultado = {
+        'escala': args.escala,
+        'tamanhos': ESCALAS[args.escala],
+        'versao': _versao_codigo(),
+        'data': datetime.utcnow().isoformat(timespec='seconds'),
+        'repeticoes': args.repeticoes,
+    }
+    # O gunicorn roda primeiro: o modo cliente importa o app neste processo e alteraria o pico de RSS
+    if args.modo in ('gunicorn', 'ambos'):
+        with tempfile.TemporaryDirectory(prefix='stockify_bench_') as pasta:
+            resultado['gunicorn'] = executar_gunicorn(_copia_de_trabalho(banco, pasta), args.repeticoes, args.rotas,
+                                                      args.workers, args.concorrencia)
+    if args.modo in ('cliente', 'ambos'):
+        with tempfile.TemporaryDirectory(prefix='stockify_bench_') as pasta:
+            resultado['cliente'] = executar_cliente(_copia_de_trabalho(banco, pasta), args.repeticoes, args.rotas)
+
+    os.makedirs(DIR_RESULTADOS, exist_ok=True)
+    saida = args.saida or os.path.join(
+        DIR_RESULTADOS, f"{args.escala}_{resultado['versao'] or 'local'}_{datetime.utcnow():%Y%m%dT%H%M%S}.json")
+    with open(saida, 'w') as f:
+        json.dump(resultado, f, indent=2, ensure_ascii=False)
+    print(f"Resultados salvos em {saida}")
+
+
+# --- COMPARAÇÃO ENTRE VERSÕES ---
+def comparar(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.novo) as f:
+        novo = json.load(f)
+    regressoes = []
+    for modo in ('cliente', 'gunicorn'):
+        if modo not in base or modo not in novo:
+            continue
+        for rota, medidas in novo[modo]['rotas'].items():
+            antes = base[modo]['rotas'].get(rota)
+            if not antes:
+                continue
+            for chave in ('p50_ms', 'p99_ms'):
+                variacao = (medidas[chave] - antes[chave]) / antes[chave] if antes[chave] else 0.0
+                marca = 'REGRESSÃO' if variacao > args.tolerancia else 'ok'
+                print(f"[{marca}] {modo} {rota} {chave}: {antes[chave]} -> {medidas[chave]} ({variacao:+.0%})")
+                if marca != 'ok':
+                    regressoes.append((modo, rota, chave))
+    if regressoes:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark do StockiFY com dados sintéticos.')
+    sub = parser.add_subparsers(dest='comando', required=True)
+
+    p_gerar = sub.add_parser('gerar', help='Gera o dataset sintético de uma escala.')
+    p_gerar.add_argument('--escala', choices=ESCALAS, default='pequena')
+    p_gerar.add_argument('--semente', type=int, default=42)
+
+    p_exec = sub.add_parser('executar', help='Mede as rotas e salva o resultado em JSON.')
+    p_exec.add_argument('--escala', choices=ESCALAS, default='pequena')
+    p_exec.add_argument('--modo', choices=['cliente', 'gunicorn', 'ambos'], default='ambos')
+    p_exec.add_argument('--repeticoes', type=int, default=50, help='Requisições por rota (rotas pesadas usam uma fração).')
+    p_exec.add_argument('--rotas', nargs='*', help='Mede só estas rotas (nomes do relatório).')
+    p_exec.add_argument('--workers', type=int, default=4)
+    p_exec.add_argument('--concorrencia', type=int, default=8)
+    p_exec.add_argument('--saida', help='Arquivo JSON de saída.')
+
+    p_comp = sub.add_parser('comparar', help='Compara dois resultados e falha se houver regressão.')
+    p_comp.add_argument('base')
+    p_comp.add_argument('novo')
+    p_comp.add_argument('--tolerancia', type=float, default=0.2, help='Aumento máximo aceito (0.2 = 20%%).')
+
+    args = parser.parse_args()
+    if args.comando == 'gerar':
+        gerar(args.escala, args.semente)
+    elif args.comando == 'executar':
+        executar(args)
+    else:
+        comparar(args)
+
+
+if __name__ == '__main__':
+    main()
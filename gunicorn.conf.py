@@ -0,0 +1,28 @@
+# Configuração lida automaticamente pelo gunicorn quando iniciado nesta pasta (gunicorn app:app).
+# Antes do primeiro deploy (e a cada atualização), com o mesmo perfil e as mesmas variáveis do gunicorn:
+#   STOCKIFY_PERFIL=producao STOCKIFY_SECRET_KEY=... STOCKIFY_ADMIN_SENHA=... flask --app app inicializar
+import os
+
+os.environ.setdefault('STOCKIFY_PERFIL', 'producao') # Exige STOCKIFY_SECRET_KEY
+
+wsgi_app = 'app:app'
+
+# Workers em thread: as conexões SSE (/eventos/inventario) ficam ociosas a maior parte do tempo e
+# cada uma ocupa só uma thread, não um worker inteiro como no modo sync. Essas threads são as mesmas
+# das requisições comuns, então cada worker aceita no máximo STOCKIFY_SSE_POR_WORKER streams (padrão:
+# metade de STOCKIFY_THREADS); as telas além disso funcionam sem atualização ao vivo. Para mais telas
+# abertas ao mesmo tempo, aumente STOCKIFY_THREADS (threads ociosas custam pouca memória).
+worker_class = 'gthread'
+workers = int(os.environ.get('STOCKIFY_WORKERS', 2))
+threads = int(os.environ.get('STOCKIFY_THREADS', 64))
+timeout = 120 # Com gthread o timeout vale para o worker, não para cada stream aberto
+
+# O master importa e configura a aplicação uma vez (numpy, RapidFuzz, SQLAlchemy, templates) e os
+# workers nascem por fork, compartilhando essa memória; create_app() não abre conexões com o banco.
+preload_app = True
+
+def post_fork(server, worker):
+    # Garante que nenhum worker herde uma conexão SQLite aberta pelo master
+    from app import app, db
+    with app.app_context():
+        db.engine.dispose(close=False)